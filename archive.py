@@ -0,0 +1,120 @@
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, delete, func, exists, literal, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import ARCHIVE_AFTER_DAYS
+from database import SessionLocal
+from models import Schedule, Booking, BookingReminder, ScheduleArchive, BookingArchive
+
+logger = logging.getLogger(__name__)
+
+# Сколько строк переносится за одну транзакцию
+ARCHIVE_BATCH_SIZE = 5000
+
+BOOKING_COLUMNS = (
+    "id", "date", "end_date", "user_id", "service_id",
+    "schedule_id", "staff_id", "confirmed"
+)
+SCHEDULE_COLUMNS = ("id", "date", "staff_id", "capacity")
+
+
+def month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+
+def next_month(value: datetime) -> datetime:
+    if value.month == 12:
+        return datetime(value.year + 1, 1, 1)
+    return datetime(value.year, value.month + 1, 1)
+
+
+async def ensure_partitions(session: AsyncSession, table: str, start: datetime, end: datetime):
+    """Создаёт помесячные секции архивной таблицы, покрывающие [start, end)"""
+    if session.bind.dialect.name != "postgresql":
+        return
+
+    current = month_start(start)
+    while current < end:
+        upper = next_month(current)
+        await session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {table}_y{current.year}m{current.month:02d} "
+            f"PARTITION OF {table} "
+            f"FOR VALUES FROM ('{current:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')"
+        ))
+        current = upper
+
+
+async def archive_batch(session: AsyncSession, source, target, columns, ids, archived_at):
+    """Копирует строки в архив и удаляет их из рабочей таблицы"""
+    source_columns = [getattr(source, name) for name in columns]
+    await session.execute(
+        insert(target).from_select(
+            [*columns, "archived_at"],
+            select(*source_columns, literal(archived_at)).where(source.id.in_(ids))
+        )
+    )
+    await session.execute(delete(source).where(source.id.in_(ids)))
+
+
+async def archive_past_records():
+    """Ночная задача: переносит старые записи и слоты в секционированный архив,
+    чтобы рабочие таблицы содержали только актуальные данные"""
+    cutoff = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    archived_at = datetime.now()
+    moved_bookings = 0
+    moved_slots = 0
+
+    try:
+        async with SessionLocal() as session:
+            async with session.begin():
+                # Дата записи всегда совпадает с датой её слота
+                oldest = await session.execute(
+                    select(func.min(Schedule.date)).where(Schedule.date < cutoff)
+                )
+                oldest = oldest.scalar()
+                if oldest is None:
+                    return
+                await ensure_partitions(session, BookingArchive.__tablename__, oldest, cutoff)
+                await ensure_partitions(session, ScheduleArchive.__tablename__, oldest, cutoff)
+
+            # Сначала записи: слоты нельзя удалить, пока на них ссылаются записи
+            while True:
+                async with session.begin():
+                    ids = await session.execute(
+                        select(Booking.id)
+                        .where(Booking.date < cutoff)
+                        .order_by(Booking.id)
+                        .limit(ARCHIVE_BATCH_SIZE)
+                    )
+                    ids = ids.scalars().all()
+                    if not ids:
+                        break
+                    await session.execute(
+                        delete(BookingReminder).where(BookingReminder.booking_id.in_(ids))
+                    )
+                    await archive_batch(session, Booking, BookingArchive, BOOKING_COLUMNS, ids, archived_at)
+                    moved_bookings += len(ids)
+
+            while True:
+                async with session.begin():
+                    ids = await session.execute(
+                        select(Schedule.id)
+                        .where(
+                            Schedule.date < cutoff,
+                            ~exists().where(Booking.schedule_id == Schedule.id)
+                        )
+                        .order_by(Schedule.id)
+                        .limit(ARCHIVE_BATCH_SIZE)
+                    )
+                    ids = ids.scalars().all()
+                    if not ids:
+                        break
+                    await archive_batch(session, Schedule, ScheduleArchive, SCHEDULE_COLUMNS, ids, archived_at)
+                    moved_slots += len(ids)
+
+        logger.info("Архивировано записей: %s, слотов: %s", moved_bookings, moved_slots)
+
+    except Exception as e:
+        logger.error("Ошибка архивации: %s", e, exc_info=True)
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, IntegrityError, ProgrammingError
+
+from database import SessionLocal
+from models import BookingEvent
+
+logger = logging.getLogger(__name__)
+
+# Типы событий по записям
+EVENT_CREATED = "created"
+EVENT_RESCHEDULED = "rescheduled"
+EVENT_CANCELLED = "cancelled"
+EVENT_REMINDED = "reminded"
+
+SYSTEM_ACTOR = "system"
+
+# Ошибки, которые повтор той же пачки не исправит
+PERSISTENT_ERRORS = (DataError, IntegrityError, ProgrammingError, TypeError, ValueError)
+
+
+class AuditBuffer:
+    """Буфер событий журнала записей.
+
+    Обработчики только добавляют событие в память, а фоновая задача
+    сбрасывает накопленное одним многострочным INSERT раз в flush_interval
+    секунд или как только набралось max_batch событий.
+
+    Пачка, которую не удалось записать из-за ошибки данных, пишется по
+    одному событию, и отброшены будут только те, что не записываются сами
+    по себе. При недоступности БД пачка остаётся в буфере и повторяется при
+    каждом сбросе, пока БД не вернётся. Буфер ограничен max_pending
+    событиями: когда он полон, новые события отбрасываются (уже накопленные
+    важнее), а их число попадает в журнал.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = 2.0,
+        max_batch: int = 500,
+        max_pending: int = 50000
+    ):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self._failed_attempts = 0
+        self._dropped = 0
+        self._pending = []
+        self._in_flight = 0
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    def record(
+        self,
+        event_type: str,
+        booking_id: int,
+        user_id: Optional[int],
+        actor_id,
+        booking_date: Optional[datetime] = None,
+        **details
+    ):
+        """Добавляет событие в буфер без обращения к БД"""
+        if len(self._pending) + self._in_flight >= self.max_pending:
+            if not self._dropped:
+                logger.warning("Буфер журнала записей переполнен, новые события отбрасываются")
+            self._dropped += 1
+            return
+        self._pending.append({
+            "booking_id": booking_id,
+            "user_id": user_id,
+            "actor_id": str(actor_id),
+            "event_type": event_type,
+            "booking_date": booking_date,
+            "details": details or None,
+            "created_at": datetime.now(),
+        })
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Записывает накопленные события пачками"""
+        while self._pending:
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            self._in_flight = len(batch)
+            try:
+                await self._insert(batch)
+            except asyncio.CancelledError:
+                # Задачу отменили посреди записи: пачка не должна пропасть
+                self._pending[:0] = batch
+                raise
+            except PERSISTENT_ERRORS as e:
+                # Повтор той же пачки не поможет: не держим за ней остальные события
+                logger.error("Ошибка данных в пачке журнала событий: %s", e)
+                try:
+                    await self._insert_one_by_one(batch)
+                except Exception as e:
+                    self._failed_attempts += 1
+                    logger.error("Ошибка записи журнала событий (попытка %s): %s", self._failed_attempts, e)
+                    return
+            except Exception as e:
+                # БД недоступна: возвращаем пачку в начало очереди до следующего сброса
+                self._failed_attempts += 1
+                logger.error("Ошибка записи журнала событий (попытка %s): %s", self._failed_attempts, e)
+                self._pending[:0] = batch
+                return
+            finally:
+                self._in_flight = 0
+            self._failed_attempts = 0
+            if self._dropped:
+                logger.error("Из-за переполнения буфера потеряно событий журнала: %s", self._dropped)
+                self._dropped = 0
+
+    async def _insert(self, rows):
+        async with SessionLocal() as session:
+            await session.execute(insert(BookingEvent), rows)
+            await session.commit()
+
+    async def _insert_one_by_one(self, batch):
+        """Пишет пачку по одному событию; отбрасываются только события с ошибкой
+        данных, а если пропала БД - остаток возвращается в буфер"""
+        dropped = 0
+        for index, row in enumerate(batch):
+            try:
+                await self._insert([row])
+            except PERSISTENT_ERRORS as e:
+                dropped += 1
+                logger.error("Событие журнала отброшено: %s (%s)", row, e)
+            except BaseException:
+                self._pending[:0] = batch[index:]
+                raise
+        if dropped:
+            logger.error("Из пачки журнала событий отброшено %s из %s", dropped, len(batch))
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу и сбрасывает остаток событий.
+
+        Задача не отменяется, а дописывает текущую пачку и выходит сама:
+        отмена посреди INSERT потеряла бы события при остановке.
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._pending:
+            logger.error("При остановке не записано событий журнала: %s", len(self._pending))
+
+
+audit_log = AuditBuffer()
+record_event = audit_log.record
@@ -0,0 +1,66 @@
+"""Микробенчмарк клавиатур: сборка и сериализация на один ответ.
+
+Запуск из корня проекта: python -m benchmarks.bench_keyboards
+"""
+import os
+import timeit
+
+os.environ.setdefault("TOKEN", "42:bench")
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.methods import SendMessage
+from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
+
+from keyboards import CachedMarkupSession, cached_reply_keyboard, get_client_keyboard
+
+NUMBER = 20000
+
+SERVICES = [[f"Услуга {i} - {i * 100}₽"] for i in range(1, 9)] + [["🔙 Назад"]]
+
+
+def build_client_keyboard():
+    # Так клавиатура собиралась раньше - заново на каждый ответ
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="💈 Записаться на услугу"), KeyboardButton(text="📋 Мои записи")],
+            [KeyboardButton(text="🔄 Перенести запись"), KeyboardButton(text="❌ Отменить запись")],
+            [KeyboardButton(text="📝 Оставить отзыв")]
+        ],
+        resize_keyboard=True
+    )
+
+
+def build_services_keyboard():
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=text) for text in row] for row in SERVICES],
+        resize_keyboard=True
+    )
+
+
+def report(name, seconds):
+    print(f"{name:<40} {seconds / NUMBER * 1e6:8.2f} мкс на ответ")
+
+
+def main():
+    bot = Bot(token=os.environ["TOKEN"])
+    plain = AiohttpSession()
+    cached = CachedMarkupSession()
+
+    def reply(session, markup):
+        session.build_form_data(bot, SendMessage(chat_id=1, text="Главное меню", reply_markup=markup))
+
+    cases = [
+        ("клиентская: сборка + отправка (было)", lambda: reply(plain, build_client_keyboard())),
+        ("клиентская: из кэша (стало)", lambda: reply(cached, get_client_keyboard())),
+        ("услуги: сборка + отправка (было)", lambda: reply(plain, build_services_keyboard())),
+        ("услуги: из кэша (стало)", lambda: reply(cached, cached_reply_keyboard(SERVICES))),
+    ]
+    for name, case in cases:
+        case()  # прогрев: первая сериализация кэшируемой клавиатуры
+        report(name, timeit.timeit(case, number=NUMBER))
+
+
+if __name__ == "__main__":
+    main()
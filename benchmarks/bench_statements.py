@@ -0,0 +1,107 @@
+"""Микробенчмарк горячих запросов: накладные расходы Python на один запрос
+при сборке select() на каждый вызов и с готовыми запросами из statements.py.
+
+Запуск из корня проекта (SQLite в памяти, так что время - почти целиком
+построение, ключ кэша и компиляция на стороне SQLAlchemy):
+    python -m benchmarks.bench_statements
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("TOKEN", "42:bench")
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+
+from sqlalchemy import select
+
+from database import SessionLocal, engine, init_db
+from models import Booking, Schedule, Service, User
+from slots import overlapping_bookings_query
+from statements import (
+    OVERLAPPING_BOOKINGS,
+    SERVICE_BY_NAME,
+    SLOTS_IN_RANGE,
+    UPCOMING_USER_BOOKINGS,
+    USER_BY_TELEGRAM_ID,
+)
+
+NUMBER = 3000
+
+
+async def seed():
+    await init_db()
+    now = datetime.now().replace(minute=0, second=0, microsecond=0)
+    async with SessionLocal() as session:
+        user = User(telegram_id="1", first_name="Иван", last_name="Иванов", phone="+70000000000")
+        service = Service(name="Стрижка", price=1000)
+        session.add_all([user, service])
+        await session.flush()
+        for hour in range(8):
+            slot = Schedule(date=now + timedelta(days=1, hours=hour))
+            session.add(slot)
+            await session.flush()
+            session.add(Booking(
+                user_id=user.id, service_id=service.id, schedule_id=slot.id, confirmed=True,
+                date=slot.date, end_date=slot.date + timedelta(minutes=60)
+            ))
+        await session.commit()
+    return now
+
+
+async def measure(session, run) -> float:
+    for _ in range(200):
+        (await run(session)).all()
+    started = time.perf_counter()
+    for _ in range(NUMBER):
+        (await run(session)).all()
+    return (time.perf_counter() - started) / NUMBER * 1e6
+
+
+async def main():
+    engine.echo = False
+    now = await seed()
+    start, end = now + timedelta(days=1), now + timedelta(days=2)
+
+    cases = {
+        "пользователь по telegram_id": (
+            lambda s: s.execute(select(User).where(User.telegram_id == "1")),
+            lambda s: s.execute(USER_BY_TELEGRAM_ID, {"telegram_id": "1"}),
+        ),
+        "услуга по названию": (
+            lambda s: s.execute(select(Service).where(Service.name == "Стрижка")),
+            lambda s: s.execute(SERVICE_BY_NAME, {"name": "Стрижка"}),
+        ),
+        "записи пользователя": (
+            lambda s: s.execute(
+                select(Booking, Service).join(Service)
+                .where(Booking.user_id == 1, Booking.date >= now)
+                .order_by(Booking.date)
+            ),
+            lambda s: s.execute(UPCOMING_USER_BOOKINGS, {"user_id": 1, "now": now}),
+        ),
+        "слоты и занятость на день": (
+            lambda s: s.execute(
+                select(Schedule.id, Schedule.date, Schedule.staff_id, Schedule.capacity)
+                .where(Schedule.date >= start, Schedule.date < end)
+                .order_by(Schedule.date, Schedule.id)
+            ),
+            lambda s: s.execute(SLOTS_IN_RANGE, {"start": start, "end": end}),
+        ),
+        "пересекающиеся записи": (
+            lambda s: s.execute(overlapping_bookings_query(start, end)),
+            lambda s: s.execute(OVERLAPPING_BOOKINGS, {"start": start, "end": end}),
+        ),
+    }
+
+    async with SessionLocal() as session:
+        for name, (before, after) in cases.items():
+            was = await measure(session, before)
+            now_ = await measure(session, after)
+            print(f"{name:<30} {was:7.1f} -> {now_:7.1f} мкс ({(1 - now_ / was) * 100:.0f}% меньше)")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
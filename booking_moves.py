@@ -0,0 +1,93 @@
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+
+from database import SessionLocal
+from models import Booking, BookingReminder
+from quotas import ACTION_RESCHEDULE, consume_quota
+from reminders import schedule_reminders
+from slots import find_free_slot
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз повторять перенос, если запись или слот изменились параллельно
+MOVE_RETRIES = 3
+
+MOVED = "moved"
+NOT_FOUND = "not_found"
+SLOT_MISSING = "slot_missing"
+SLOT_TAKEN = "slot_taken"
+LIMIT_REACHED = "limit_reached"
+
+
+class MoveConflict(Exception):
+    """Запись изменили между чтением и обновлением"""
+
+
+async def _try_move(booking_id: int, when: datetime, duration: int, preferred_staff_id: int = None):
+    async with SessionLocal() as session:
+        try:
+            booking = await session.execute(
+                select(Booking.id, Booking.user_id, Booking.date, Booking.version)
+                .where(Booking.id == booking_id)
+            )
+            booking = booking.first()
+            if not booking:
+                return NOT_FOUND, None
+
+            slot_exists, slot = await find_free_slot(
+                session, when, duration, exclude_booking_id=booking.id,
+                preferred_staff_id=preferred_staff_id
+            )
+            if not slot_exists:
+                return SLOT_MISSING, booking
+            if not slot:
+                return SLOT_TAKEN, booking
+
+            # Лимит засчитывается в этой же транзакции и откатится вместе с ней
+            if not await consume_quota(session, booking.user_id, ACTION_RESCHEDULE):
+                await session.rollback()
+                return LIMIT_REACHED, booking
+
+            # Перенос - одно условное обновление строки: запись не удаляется,
+            # её id и история сохраняются. Пересечение со слотом другой записи
+            # отсекает ограничение в БД (IntegrityError)
+            moved = await session.execute(
+                update(Booking)
+                .where(Booking.id == booking.id, Booking.version == booking.version)
+                .values(
+                    date=when,
+                    end_date=when + timedelta(minutes=duration),
+                    schedule_id=slot.id,
+                    staff_id=slot.staff_id,
+                    version=Booking.version + 1
+                )
+                .execution_options(synchronize_session=False)
+            )
+            if moved.rowcount != 1:
+                raise MoveConflict(booking.id)
+
+            # Напоминания считаются от нового времени
+            await session.execute(
+                delete(BookingReminder).where(BookingReminder.booking_id == booking.id)
+            )
+            schedule_reminders(session, booking.id, when)
+            await session.commit()
+            return MOVED, booking
+        except Exception:
+            await session.rollback()
+            raise
+
+
+async def move_booking(booking_id: int, when: datetime, duration: int, preferred_staff_id: int = None):
+    """Переносит запись на время when, по возможности к мастеру preferred_staff_id.
+    Возвращает (статус, строка записи до переноса). При гонке с другим
+    переносом или записью на тот же слот повторяет попытку с новыми данными."""
+    for attempt in range(1, MOVE_RETRIES + 1):
+        try:
+            return await _try_move(booking_id, when, duration, preferred_staff_id)
+        except (MoveConflict, IntegrityError) as e:
+            logger.info("Конфликт при переносе записи %s (попытка %s): %s", booking_id, attempt, type(e).__name__)
+    return SLOT_TAKEN, None
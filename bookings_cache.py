@@ -0,0 +1,100 @@
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from config import UPCOMING_CACHE_TTL, READ_YOUR_WRITES_SECONDS
+from database import ReadSessionLocal, SessionLocal
+from invalidation import invalidation_bus, TOPIC_USER_BOOKINGS
+from statements import USER_ID_BY_TELEGRAM_ID, UPCOMING_USER_BOOKINGS
+
+
+class UpcomingBookingsCache:
+    """Предстоящие записи пользователя на несколько секунд.
+
+    "Мои записи", перенос и отмена показывают один и тот же список, и при
+    переходах назад-вперёд он берётся из памяти. Запись, перенос и отмена
+    сбрасывают его кэш на всех репликах, см. bookings_changed и invalidation.
+    Записи, время которых прошло, отфильтровываются при чтении.
+
+    Проверка "писал ли пользователь недавно" в ReadSessionLocal знает только
+    о коммитах своего процесса. Поэтому после сброса кэш несколько секунд
+    перечитывается с основной БД: иначе реплика, получившая уведомление от
+    другого процесса, закэшировала бы отстающий список на весь ttl.
+    """
+
+    def __init__(self, ttl: float = UPCOMING_CACHE_TTL):
+        self.ttl = ttl
+        # telegram id -> (момент устаревания, строки записей)
+        self._entries: Dict[int, Tuple[float, List]] = {}
+        # telegram id -> до какого момента читать с основной БД
+        self._primary_until: Dict[int, float] = {}
+        self._all_primary_until = 0.0
+
+    async def get(self, telegram_id: int) -> Optional[List]:
+        """Строки (id, date, confirmed, service_name) по возрастанию даты;
+        None - пользователь не зарегистрирован"""
+        now = time.monotonic()
+        entry = self._entries.get(telegram_id)
+        if entry is None or entry[0] <= now:
+            rows = await self._load(telegram_id, self._read_primary(telegram_id, now))
+            if rows is None:
+                return None
+            entry = (now + self.ttl, rows)
+            self._entries[telegram_id] = entry
+            if len(self._entries) > 10000:
+                self._evict_expired(now)
+
+        current = datetime.now()
+        return [row for row in entry[1] if row.date >= current]
+
+    def _read_primary(self, telegram_id: int, now: float) -> bool:
+        if now < self._all_primary_until:
+            return True
+        until = self._primary_until.get(telegram_id)
+        if until is None:
+            return False
+        if until <= now:
+            del self._primary_until[telegram_id]
+            return False
+        return True
+
+    async def _load(self, telegram_id: int, primary: bool = False) -> Optional[List]:
+        async with (SessionLocal() if primary else ReadSessionLocal()) as session:
+            user_id = await session.execute(
+                USER_ID_BY_TELEGRAM_ID, {"telegram_id": str(telegram_id)}
+            )
+            user_id = user_id.scalar()
+            if not user_id:
+                return None
+
+            bookings = await session.execute(
+                UPCOMING_USER_BOOKINGS, {"user_id": user_id, "now": datetime.now()}
+            )
+            return bookings.all()
+
+    def invalidate(self, telegram_id: Optional[int] = None):
+        now = time.monotonic()
+        primary_until = now + READ_YOUR_WRITES_SECONDS
+        if telegram_id is None:
+            self._entries.clear()
+            self._all_primary_until = primary_until
+        else:
+            self._entries.pop(telegram_id, None)
+            self._primary_until[telegram_id] = primary_until
+            if len(self._primary_until) > 10000:
+                self._evict_expired(now)
+
+    def _evict_expired(self, now: float):
+        for key in [key for key, (expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+        for key in [key for key, until in self._primary_until.items() if until <= now]:
+            del self._primary_until[key]
+
+
+upcoming_bookings = UpcomingBookingsCache()
+invalidation_bus.subscribe(TOPIC_USER_BOOKINGS, upcoming_bookings.invalidate)
+
+
+def bookings_changed(telegram_id: int):
+    """Вызывается после коммита, изменившего записи пользователя"""
+    invalidation_bus.publish(TOPIC_USER_BOOKINGS, telegram_id)
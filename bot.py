@@ -1,162 +1,171 @@
 import asyncio
 import logging
+import sys
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.fsm.storage.memory import MemoryStorage
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from datetime import datetime, timedelta
 
-from config import TOKEN
-from database import init_db
-from handlers.admin import (
-    process_broadcast_message,
-    view_bookings_handler,
-    create_schedule_handler,
-    create_schedule_process,
-    add_service_handler,
-    process_add_service,
-    edit_service_handler,
-    select_service_to_edit,
-    process_edit_service,
-    delete_service_handler,
-    delete_service_confirm,
-    broadcast_handler,
-    broadcast_send,
-    view_bookings_select_day,
-    view_bookings_select_month,
-    view_feedbacks_handler,
-    view_schedule_handler,
-    client_functions_handler
-)
-from handlers.user import (
-    cancel_select_booking,
-    feedback_handler,
-    process_feedback_rating,
-    process_feedback_text,
-    process_reschedule_confirmation,
-    send_booking_reminders,
-    start_handler,
-    process_first_name,
-    process_last_name,
-    process_phone,
-    start_booking,
-    select_service,
-    select_month,
-    select_day,
-    select_time,
-    my_bookings_handler,
-    reschedule_handler,
-    reschedule_select_booking,
-    reschedule_new_month,
-    reschedule_new_day,
-    reschedule_new_time,
-    cancel_handler,
-    cancel_confirm,
-    process_booking_confirmation,
-    process_booking_actions,
-    process_cancel_confirmation,
-    process_rebooking
+from config import TOKEN, THROTTLE_RATE, THROTTLE_BURST, RESET_DB_ON_START, RUN_WORKER_IN_BOT
+from database import dispose_engines, init_db
+from audit import audit_log
+from middlewares import (
+    ThrottlingMiddleware, ActivityMiddleware, InFlightMiddleware, UserContextMiddleware,
+    UpdateLogMiddleware, HandlerNameMiddleware
 )
+from health import health
+from shutdown import drain, in_flight
+from keyboards import CachedMarkupSession
+from leader import leader
+from lazy import LazyModule
+from invalidation import invalidation_bus
+from log_setup import setup_logging
 from states import AddServiceStates, BookingStates, AdminStates, CancelStates, CreateScheduleStates, DeleteServiceStates, EditServiceStates, FeedbackStates, RegistrationStates, RescheduleStates, ViewBookingsStates
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# Модули обработчиков загружаются при первом апдейте, который до них дошёл:
+# на старте импортируются только aiogram, БД и клавиатуры
+admin = LazyModule("handlers.admin")
+user = LazyModule("handlers.user")
+
+async def on_startup():
+    health.polling = True
+
+async def on_shutdown():
+    health.polling = False
+
 async def main():
+    # Сервер проверок поднимается первым: пока идёт инициализация,
+    # /health отвечает, а /ready - нет
+    health.polling = False
+    await health.start()
     try:
-        await init_db()
+        await init_db(reset=RESET_DB_ON_START)
         logger.info("Database initialized successfully")
     except Exception as e:
-        logger.error(f"Failed to initialize database: {e}")
-        return
+        logger.error("Failed to initialize database: %s", e)
+        await health.stop()
+        # Ненулевой код выхода: оркестратор перезапустит контейнер
+        sys.exit(1)
+
+    # Фоновый сброс журнала событий по записям
+    audit_log.start()
+    # Сброс кэшей по изменениям, сделанным другими репликами
+    await invalidation_bus.start()
 
     storage = MemoryStorage()
-    bot = Bot(token=TOKEN)
+    bot = Bot(token=TOKEN, session=CachedMarkupSession())
     dp = Dispatcher(storage=storage)
     
+    # Защита от флуда: лишние апдейты отбрасываются до фильтров и обработчиков
+    throttling = ThrottlingMiddleware(rate=THROTTLE_RATE, burst=THROTTLE_BURST)
+    dp.message.outer_middleware(throttling)
+    dp.callback_query.outer_middleware(throttling)
+    # Контекст журнала (update_id, пользователь, обработчик) и время обработки
+    dp.update.outer_middleware(UpdateLogMiddleware())
+    dp.message.middleware(HandlerNameMiddleware())
+    dp.callback_query.middleware(HandlerNameMiddleware())
+    # Время последнего обработанного апдейта для /ready
+    dp.update.outer_middleware(ActivityMiddleware(health.touch))
+    # Остановка дожидается апдейтов, которые уже начали обрабатываться
+    dp.update.outer_middleware(InFlightMiddleware(in_flight))
+    # Пользователь апдейта для выбора между репликой и основной БД
+    dp.update.outer_middleware(UserContextMiddleware())
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    
     # Регистрация обработчиков
-    dp.message.register(start_handler, Command("start"))
+    dp.message.register(user.start_handler, Command("start"))
     
     # Административные обработчики
-    dp.message.register(view_bookings_handler, lambda m: m.text == "👁️ Просмотр записей")
-    dp.message.register(create_schedule_handler, lambda m: m.text == "📅 Создать расписание")
-    dp.message.register(add_service_handler, lambda m: m.text == "📝 Добавить услугу")
-    dp.message.register(edit_service_handler, lambda m: m.text == "✏️ Редактировать услугу")
-    dp.message.register(delete_service_handler, lambda m: m.text == "🗑️ Удалить услугу")
-    dp.message.register(broadcast_handler, lambda m: m.text == "📢 Рассылка")
-    dp.message.register(view_schedule_handler, lambda m: m.text == "📋 Посмотреть расписание")
-    dp.message.register(client_functions_handler, lambda m: m.text == "📋 Клиентские функции")
-    dp.message.register(view_feedbacks_handler, lambda m: m.text == "📝 Посмотреть отзывы")
+    dp.message.register(admin.view_bookings_handler, lambda m: m.text == "👁️ Просмотр записей")
+    dp.message.register(admin.create_schedule_handler, lambda m: m.text == "📅 Создать расписание")
+    dp.message.register(admin.add_service_handler, lambda m: m.text == "📝 Добавить услугу")
+    dp.message.register(admin.edit_service_handler, lambda m: m.text == "✏️ Редактировать услугу")
+    dp.message.register(admin.delete_service_handler, lambda m: m.text == "🗑️ Удалить услугу")
+    dp.message.register(admin.broadcast_handler, lambda m: m.text == "📢 Рассылка")
+    dp.message.register(admin.view_schedule_handler, lambda m: m.text == "📋 Посмотреть расписание")
+    dp.message.register(admin.client_functions_handler, lambda m: m.text == "📋 Клиентские функции")
+    dp.message.register(admin.view_feedbacks_handler, lambda m: m.text == "📝 Посмотреть отзывы")
     
     # Состояния администратора
-    dp.message.register(create_schedule_process, CreateScheduleStates.waiting_for_dates)
-    dp.message.register(process_add_service, AddServiceStates.waiting_for_data)
-    dp.message.register(select_service_to_edit, EditServiceStates.waiting_for_service)
-    dp.message.register(process_edit_service, EditServiceStates.waiting_for_new_data)
-    dp.message.register(delete_service_confirm, DeleteServiceStates.waiting_for_service)
-    dp.message.register(view_bookings_select_month, ViewBookingsStates.waiting_for_month)
-    dp.message.register(view_bookings_select_day, ViewBookingsStates.waiting_for_day)
-    dp.message.register(process_broadcast_message, AdminStates.waiting_for_broadcast_message)
+    dp.message.register(admin.create_schedule_process, CreateScheduleStates.waiting_for_dates)
+    dp.message.register(admin.process_add_service, AddServiceStates.waiting_for_data)
+    dp.message.register(admin.select_service_to_edit, EditServiceStates.waiting_for_service)
+    dp.message.register(admin.process_edit_service, EditServiceStates.waiting_for_new_data)
+    dp.message.register(admin.delete_service_confirm, DeleteServiceStates.waiting_for_service)
+    dp.message.register(admin.view_bookings_select_month, ViewBookingsStates.waiting_for_month)
+    dp.message.register(admin.view_bookings_select_day, ViewBookingsStates.waiting_for_day)
+    dp.message.register(admin.process_broadcast_message, AdminStates.waiting_for_broadcast_message)
     
     # Клиентские обработчики
-    dp.message.register(start_booking, lambda m: m.text == "💈 Записаться на услугу")
-    dp.message.register(my_bookings_handler, lambda m: m.text == "📋 Мои записи")
-    dp.message.register(reschedule_handler, lambda m: m.text == "🔄 Перенести запись")
-    dp.message.register(cancel_handler, lambda m: m.text == "❌ Отменить запись")
-    dp.message.register(feedback_handler, lambda m: m.text == "📝 Оставить отзыв")
-    dp.message.register(cancel_select_booking, CancelStates.waiting_for_booking)
-    dp.message.register(cancel_confirm, CancelStates.waiting_for_confirmation)
-    dp.message.register(process_feedback_text, FeedbackStates.waiting_for_feedback_text)
-    dp.message.register(process_feedback_rating, FeedbackStates.waiting_for_feedback_rating)
-    dp.callback_query.register(process_cancel_confirmation, CancelStates.waiting_for_confirmation)
+    dp.message.register(user.start_booking, lambda m: m.text == "💈 Записаться на услугу")
+    dp.message.register(user.my_bookings_handler, lambda m: m.text == "📋 Мои записи")
+    dp.message.register(user.reschedule_handler, lambda m: m.text == "🔄 Перенести запись")
+    dp.message.register(user.cancel_handler, lambda m: m.text == "❌ Отменить запись")
+    dp.message.register(user.feedback_handler, lambda m: m.text == "📝 Оставить отзыв")
+    dp.message.register(user.cancel_select_booking, CancelStates.waiting_for_booking)
+    dp.message.register(user.cancel_confirm, CancelStates.waiting_for_confirmation)
+    dp.message.register(user.process_feedback_text, FeedbackStates.waiting_for_feedback_text)
+    dp.message.register(user.process_feedback_rating, FeedbackStates.waiting_for_feedback_rating)
+    dp.callback_query.register(user.process_cancel_confirmation, CancelStates.waiting_for_confirmation)
     
     # Состояния регистрации
-    dp.message.register(process_first_name, RegistrationStates.waiting_for_first_name)
-    dp.message.register(process_last_name, RegistrationStates.waiting_for_last_name)
-    dp.message.register(process_phone, RegistrationStates.waiting_for_phone)
+    dp.message.register(user.process_first_name, RegistrationStates.waiting_for_first_name)
+    dp.message.register(user.process_last_name, RegistrationStates.waiting_for_last_name)
+    dp.message.register(user.process_phone, RegistrationStates.waiting_for_phone)
     
     # Состояния записи на услугу
-    dp.message.register(select_service, BookingStates.waiting_for_service)
-    dp.message.register(select_month, BookingStates.waiting_for_month)
-    dp.message.register(select_day, BookingStates.waiting_for_day)
-    dp.message.register(select_time, BookingStates.waiting_for_time)
+    dp.message.register(user.select_service, BookingStates.waiting_for_service)
+    dp.message.register(user.select_month, BookingStates.waiting_for_month)
+    dp.message.register(user.select_day, BookingStates.waiting_for_day)
+    dp.message.register(user.select_time, BookingStates.waiting_for_time)
+    dp.message.register(user.confirm_booking, BookingStates.waiting_for_confirmation)
     
     # Состояния переноса записи
-    dp.message.register(reschedule_select_booking, RescheduleStates.waiting_for_booking)
-    dp.message.register(reschedule_new_month, RescheduleStates.waiting_for_new_month)
-    dp.message.register(reschedule_new_day, RescheduleStates.waiting_for_new_day)
-    dp.message.register(reschedule_new_time, RescheduleStates.waiting_for_new_time)
+    dp.message.register(user.reschedule_select_booking, RescheduleStates.waiting_for_booking)
+    dp.message.register(user.reschedule_new_month, RescheduleStates.waiting_for_new_month)
+    dp.message.register(user.reschedule_new_day, RescheduleStates.waiting_for_new_day)
+    dp.message.register(user.reschedule_new_time, RescheduleStates.waiting_for_new_time)
+    dp.message.register(user.reschedule_confirm, RescheduleStates.waiting_for_confirmation)
     
     # Callback-обработчики
-    dp.callback_query.register(reschedule_select_booking, lambda c: c.data.startswith('select_reschedule_')) 
-    dp.callback_query.register(process_booking_confirmation, lambda c: c.data.startswith(('confirm_', 'cancel_')))
-    dp.callback_query.register(process_booking_actions, lambda c: c.data.startswith(('reschedule_', 'cancel_')))
-    dp.callback_query.register(process_cancel_confirmation, lambda c: c.data.startswith('confirm_cancel_') or c.data == 'keep_booking')
-    dp.callback_query.register(process_rebooking, lambda c: c.data.startswith('rebook_'))
+    dp.callback_query.register(user.reschedule_select_booking, lambda c: c.data.startswith('select_reschedule_')) 
+    dp.callback_query.register(user.process_booking_confirmation, lambda c: c.data.startswith(('confirm_', 'cancel_')))
+    dp.callback_query.register(user.process_booking_actions, lambda c: c.data.startswith(('reschedule_', 'cancel_')))
+    dp.callback_query.register(user.process_cancel_confirmation, lambda c: c.data.startswith('confirm_cancel_') or c.data == 'keep_booking')
+    dp.callback_query.register(user.process_rebooking, lambda c: c.data.startswith('rebook_'))
     
-    # Планировщик для напоминаний
-    scheduler = AsyncIOScheduler()
-    # Передаем экземпляр бота в функцию напоминаний
-    scheduler.add_job(
-        send_booking_reminders,
-        'interval',
-        minutes=30,
-        args=[bot],  # Передаем бота как аргумент
-        next_run_time=datetime.now()
-    )
-    scheduler.start()
+    # Фоновые задачи выполняются здесь, только если не запущен отдельный воркер
+    scheduler = None
+    if RUN_WORKER_IN_BOT:
+        # Планировщик и модули задач нужны только в этом режиме
+        from apscheduler.schedulers.asyncio import AsyncIOScheduler
+        from worker import setup_jobs
+
+        await leader.start()
+        scheduler = AsyncIOScheduler()
+        setup_jobs(scheduler, bot)
+        scheduler.start()
+        health.scheduler = scheduler
 
     try:
         logger.info("Бот запущен")
-        await dp.start_polling(bot)
+        # Сессию закрываем сами: начатым обработчикам она ещё нужна
+        await dp.start_polling(bot, close_bot_session=False)
     except Exception as e:
-        logger.error(f"Ошибка в работе бота: {e}")
+        logger.error("Ошибка в работе бота: %s", e)
     finally:
-        scheduler.shutdown()
+        # Опрос уже остановлен; ждём начатые обработчики и задачи
+        await drain(scheduler)
+        if scheduler:
+            await leader.stop()
+        await audit_log.stop()
+        await invalidation_bus.stop()
         await bot.session.close()
+        await health.stop()
+        await dispose_engines()
         logger.info("Бот остановлен")
 
 if __name__ == "__main__":
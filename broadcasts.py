@@ -0,0 +1,170 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from aiogram import Bot
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import ADMIN_ID, BROADCAST_LEASE_SECONDS
+from database import SessionLocal
+from shutdown import in_flight
+from models import BroadcastJob, User
+from sqlfuncs import db_now
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# Как часто (в получателях) сохранять курсор рассылки; после аварийного
+# завершения процесса повторно получат сообщение не больше стольких пользователей
+BROADCAST_PROGRESS_EVERY = 20
+
+
+def enqueue_broadcast(session: AsyncSession, text: str, requested_by, parse_mode: str = "HTML") -> BroadcastJob:
+    """Ставит рассылку в очередь; отправкой занимается воркер"""
+    job = BroadcastJob(
+        text=text,
+        parse_mode=parse_mode,
+        requested_by=str(requested_by),
+        status=STATUS_PENDING
+    )
+    session.add(job)
+    return job
+
+
+async def claim_next_job():
+    """Забирает следующее задание из очереди. SKIP LOCKED не даёт двум
+    воркерам взять одно и то же задание.
+
+    Задание, воркер которого упал или был убит, остаётся в статусе running
+    без новых отметок; через BROADCAST_LEASE_SECONDS его забирает другой
+    воркер и продолжает с сохранённого курсора.
+    """
+    async with SessionLocal() as session:
+        async with session.begin():
+            job = await session.execute(
+                select(BroadcastJob)
+                .where(or_(
+                    BroadcastJob.status == STATUS_PENDING,
+                    and_(
+                        BroadcastJob.status == STATUS_RUNNING,
+                        BroadcastJob.heartbeat_at < db_now(-BROADCAST_LEASE_SECONDS)
+                    )
+                ))
+                .order_by(BroadcastJob.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            )
+            job = job.scalars().first()
+            if job:
+                if job.status == STATUS_RUNNING:
+                    logger.warning("Рассылка №%s брошена воркером, продолжаем с пользователя %s", job.id, job.cursor_user_id)
+                job.status = STATUS_RUNNING
+                job.started_at = job.started_at or datetime.now()
+                job.heartbeat_at = db_now(0)
+        return job
+
+
+async def save_progress(job: BroadcastJob, cursor_user_id: int, success: int, failed: int, **values):
+    async with SessionLocal() as session:
+        await session.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job.id)
+            .values(
+                cursor_user_id=cursor_user_id,
+                success=success,
+                failed=failed,
+                heartbeat_at=db_now(0),
+                **values
+            )
+        )
+        await session.commit()
+
+
+async def run_broadcast(bot: Bot, job: BroadcastJob) -> bool:
+    """Отправляет рассылку, начиная после job.cursor_user_id. Возвращает False,
+    если процесс останавливается: задание возвращается в очередь с курсором"""
+    async with SessionLocal() as session:
+        users = await session.execute(
+            select(User.id, User.telegram_id)
+            .where(User.telegram_id != str(ADMIN_ID), User.id > job.cursor_user_id)
+            .order_by(User.id)
+        )
+        users = users.all()
+
+    cursor = job.cursor_user_id
+    success = job.success or 0
+    failed_count = job.failed or 0
+    failed = []
+
+    for number, user in enumerate(users, 1):
+        # Останавливаемся между получателями, а не посреди рассылки
+        if in_flight.stopping:
+            await save_progress(job, cursor, success, failed_count, status=STATUS_PENDING)
+            logger.info("Рассылка №%s прервана остановкой, отправлено до пользователя %s", job.id, cursor)
+            return False
+        try:
+            await bot.send_message(
+                chat_id=int(user.telegram_id),
+                text=job.text,
+                parse_mode=job.parse_mode
+            )
+            success += 1
+            await asyncio.sleep(0.1)  # Защита от лимитов Telegram
+        except Exception as e:
+            failed.append(user.telegram_id)
+            failed_count += 1
+            logger.warning("Не удалось отправить сообщение %s: %s", user.telegram_id, e)
+        cursor = user.id
+        if number % BROADCAST_PROGRESS_EVERY == 0:
+            await save_progress(job, cursor, success, failed_count)
+
+    finished_at = datetime.now()
+    total = success + failed_count
+    await save_progress(
+        job, cursor, success, failed_count,
+        status=STATUS_DONE, total=total, finished_at=finished_at
+    )
+
+    time_spent = (finished_at - job.created_at).total_seconds()
+    report = (
+        f"📊 Результаты рассылки №{job.id}\n\n"
+        f"• Получателей: {total}\n"
+        f"• Успешно: {success}\n"
+        f"• Ошибки: {failed_count}\n"
+        f"• Время: {time_spent:.2f} сек.\n\n"
+        f"Первые 10 ID с ошибками:\n{', '.join(failed[:10])}{'...' if len(failed) > 10 else ''}"
+    )
+    await bot.send_message(chat_id=int(job.requested_by), text=report)
+    return True
+
+
+async def process_broadcast_queue(bot: Bot):
+    """Задача воркера: выполняет все рассылки, ожидающие в очереди"""
+    # При остановке процесса новые задания не берём: их заберёт другой воркер
+    while not in_flight.stopping:
+        job = await claim_next_job()
+        if not job:
+            return
+        try:
+            await run_broadcast(bot, job)
+        except Exception as e:
+            logger.error("Ошибка рассылки №%s: %s", job.id, e, exc_info=True)
+            async with SessionLocal() as session:
+                await session.execute(
+                    update(BroadcastJob)
+                    .where(BroadcastJob.id == job.id)
+                    .values(status=STATUS_FAILED, finished_at=datetime.now())
+                )
+                await session.commit()
+            try:
+                await bot.send_message(
+                    chat_id=int(job.requested_by),
+                    text=f"❌ Критическая ошибка рассылки №{job.id}: {str(e)}"
+                )
+            except Exception:
+                pass
@@ -6,6 +6,66 @@ load_dotenv()
 TOKEN = os.getenv("TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", 0))
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Сколько переносов и отмен записи доступно пользователю в месяц
+RESCHEDULE_MONTHLY_LIMIT = int(os.getenv("RESCHEDULE_MONTHLY_LIMIT", 1))
+CANCEL_MONTHLY_LIMIT = int(os.getenv("CANCEL_MONTHLY_LIMIT", 1))
+# Сколько секунд держать в памяти список предстоящих записей пользователя
+UPCOMING_CACHE_TTL = float(os.getenv("UPCOMING_CACHE_TTL", 30))
+# Сколько секунд выбранное время закреплено за пользователем до подтверждения записи
+SLOT_HOLD_SECONDS = float(os.getenv("SLOT_HOLD_SECONDS", 120))
+# Канал Postgres LISTEN/NOTIFY, по которому реплики сообщают друг другу об изменениях
+INVALIDATION_CHANNEL = os.getenv("INVALIDATION_CHANNEL", "cache_invalidation")
+# Сколько секунд держать в памяти услуги и месяцы с расписанием; изменения
+# сбрасывают кэш сразу, срок - страховка на случай потерянного уведомления
+SHARED_CACHE_TTL = float(os.getenv("SHARED_CACHE_TTL", 300))
+# Размер кэша подготовленных операторов asyncpg на соединение
+# (0 - выключить, нужно при работе через pgbouncer в режиме transaction)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 500))
+# Реплики только для чтения через запятую (необязательно)
+DATABASE_REPLICA_URLS = tuple(
+    url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()
+)
+# Сколько секунд после своей записи пользователь читает из основной БД,
+# а не с реплики (должно быть больше типичного отставания реплики)
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
+# Пересоздавать ли таблицы при запуске бота (удаляет все данные, в том числе
+# очередь рассылок и напоминания работающего воркера!). Только для разработки
+# и для однократного обновления БД, созданной прежней версией бота: без этого
+# бот с такой БД не запустится (см. database.init_db)
+RESET_DB_ON_START = os.getenv("RESET_DB_ON_START", "0") == "1"
+# Выполнять ли фоновые задачи (напоминания, архив, рассылки) в процессе бота.
+# При запуске отдельного воркера (python -m worker) нужно выставить 0
+RUN_WORKER_IN_BOT = os.getenv("RUN_WORKER_IN_BOT", "1") == "1"
+# Как часто воркер проверяет очередь рассылок, секунд
+BROADCAST_POLL_INTERVAL = int(os.getenv("BROADCAST_POLL_INTERVAL", 5))
+# Через сколько секунд без отметки воркера выполняющаяся рассылка забирается другим
+BROADCAST_LEASE_SECONDS = int(os.getenv("BROADCAST_LEASE_SECONDS", 300))
+# Срок аренды фоновой задачи, секунд: через столько другая реплика
+# подхватит задачи, если держатель аренды упал
+LEADER_LEASE_SECONDS = int(os.getenv("LEADER_LEASE_SECONDS", 90))
+# Через сколько дней прошедшие слоты и записи переносятся в архив
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 30))
+# Ограничение частоты запросов: запросов в секунду и размер "пачки"
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", 1.0))
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", 5))
+# За сколько минут до записи отправляются напоминания, через запятую
+REMINDER_OFFSETS = tuple(
+    int(offset) for offset in os.getenv("REMINDER_OFFSETS", "1440,180").split(",") if offset.strip()
+)
+# HTTP-сервер проверок здоровья (/health, /ready)
+HEALTH_HOST = os.getenv("HEALTH_HOST", "0.0.0.0")
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", 8000))
+# Через сколько секунд без апдейтов реплика считается неготовой, 0 - не проверять
+HEALTH_MAX_UPDATE_AGE = int(os.getenv("HEALTH_MAX_UPDATE_AGE", 0))
+# Сколько секунд при остановке ждать завершения начатых обработчиков и задач
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 25))
+# Журнал: уровень, формат (json - строка JSON на запись, text - для разработки)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Доля апдейтов, чьи записи ниже WARNING попадают в журнал (1 - все)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 1.0))
+# Печатать все SQL-запросы (только для отладки)
+SQL_ECHO = os.getenv("SQL_ECHO", "0") == "1"
 
 if not all([TOKEN, DATABASE_URL]):
     raise ValueError("Missing required environment variables")
\ No newline at end of file
@@ -1,23 +1,144 @@
+import contextvars
+import itertools
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import event, inspect
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
-from config import DATABASE_URL
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from config import DATABASE_URL, DATABASE_REPLICA_URLS, READ_YOUR_WRITES_SECONDS, DB_STATEMENT_CACHE_SIZE, SQL_ECHO
 import logging
 
-engine = create_async_engine(
-    DATABASE_URL,
-    echo=True,
+ENGINE_OPTIONS = dict(
     pool_pre_ping=True,  # Проверка соединения перед использованием
     pool_recycle=3600    # Пересоздание соединений каждый час
 )
-SessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+
+def engine_options(url: str) -> dict:
+    options = dict(ENGINE_OPTIONS)
+    if "+asyncpg" in url:
+        # asyncpg держит на каждом соединении кэш подготовленных операторов
+        # по тексту SQL; горячие запросы (statements.py) дают одинаковый текст
+        options["connect_args"] = {"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    return options
+
+
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=SQL_ECHO,
+    **engine_options(DATABASE_URL)
+)
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    """Встроенный режим на SQLite: WAL позволяет читать во время записи,
+    внешние ключи (ON DELETE CASCADE) в SQLite по умолчанию выключены"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine.sync_engine, "connect", _sqlite_pragmas)
+
+
+class PrimarySession(Session):
+    """Сессия основной БД: её коммиты отмечают пользователя как недавно писавшего"""
+
+
+SessionLocal = sessionmaker(
+    bind=engine, class_=AsyncSession, expire_on_commit=False, sync_session_class=PrimarySession
+)
 Base = declarative_base()
 
-async def init_db():
+# Реплики только для чтения, опрашиваются по кругу
+replica_engines = [create_async_engine(url, **engine_options(url)) for url in DATABASE_REPLICA_URLS]
+_replica_sessions = [
+    sessionmaker(bind=replica, class_=AsyncSession, expire_on_commit=False)
+    for replica in replica_engines
+]
+_next_replica = itertools.cycle(range(len(_replica_sessions)))
+
+# Telegram id пользователя, чей апдейт сейчас обрабатывается (см. UserContextMiddleware)
+current_user_id: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("current_user_id", default=None)
+# telegram id -> время последнего коммита в основную БД (monotonic)
+_last_write: Dict[int, float] = {}
+
+
+@event.listens_for(PrimarySession, "after_commit")
+def _remember_write(session):
+    user_id = current_user_id.get()
+    if user_id is None:
+        return
+    now = time.monotonic()
+    _last_write[user_id] = now
+    if len(_last_write) > 10000:
+        for stale in [uid for uid, at in _last_write.items() if now - at > READ_YOUR_WRITES_SECONDS]:
+            del _last_write[stale]
+
+
+def wrote_recently(user_id: Optional[int]) -> bool:
+    last = _last_write.get(user_id) if user_id is not None else None
+    return last is not None and time.monotonic() - last < READ_YOUR_WRITES_SECONDS
+
+
+def ReadSessionLocal() -> AsyncSession:
+    """Сессия для запросов только на чтение. Идёт на реплику, если она настроена
+    и текущий пользователь ничего не записывал последние READ_YOUR_WRITES_SECONDS
+    секунд - иначе он мог бы не увидеть собственную запись из-за отставания реплики"""
+    if not _replica_sessions or wrote_recently(current_user_id.get()):
+        return SessionLocal()
+    return _replica_sessions[next(_next_replica)]()
+
+
+async def dispose_engines():
+    """Закрывает пулы соединений основной БД и реплик"""
+    for db_engine in (engine, *replica_engines):
+        await db_engine.dispose()
+
+
+class OutdatedSchemaError(RuntimeError):
+    """Существующие таблицы созданы по старой схеме: create_all их не изменяет"""
+
+
+def _missing_columns(sync_conn) -> List[str]:
+    """Столбцы моделей, которых нет в уже существующих таблицах"""
+    inspector = inspect(sync_conn)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend(f"{table.name}.{column.name}" for column in table.columns if column.name not in existing)
+    return missing
+
+
+async def init_db(reset: bool = True):
+    """Создаёт недостающие таблицы; reset - предварительно удалить все таблицы.
+
+    Миграций нет: если таблицы остались от прежней версии бота (раньше они
+    пересоздавались при каждом запуске), запуск прерывается. Обновить такую
+    БД можно одним запуском с RESET_DB_ON_START=1 (данные будут удалены)
+    или добавив перечисленные в ошибке столбцы вручную.
+    """
     try:
         async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.drop_all)
+            if reset:
+                await conn.run_sync(Base.metadata.drop_all)
             await conn.run_sync(Base.metadata.create_all)
+            missing = await conn.run_sync(_missing_columns)
+        if missing:
+            raise OutdatedSchemaError(
+                "Схема БД устарела, нет столбцов: %s. Запустите бота один раз с "
+                "RESET_DB_ON_START=1 (данные будут удалены) или добавьте столбцы вручную"
+                % ", ".join(missing)
+            )
         logging.info("Database initialized successfully")
     except Exception as e:
-        logging.error(f"Error initializing database: {e}")
-        raise
\ No newline at end of file
+        logging.error("Error initializing database: %s", e)
+        raise
@@ -1,17 +1,15 @@
-import asyncio
+import html
 import re
 import logging
 from datetime import datetime, timedelta
 from typing import Optional, Tuple
 
-from aiogram import Bot, types
+from aiogram import types
 from aiogram.fsm.context import FSMContext
-from sqlalchemy import select, func, and_, exists, delete
-from sqlalchemy.ext.asyncio import AsyncSession
-from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
+from sqlalchemy import select, func
 
-from database import SessionLocal
-from models import Feedback, User, Service, Schedule, Booking
+from database import SessionLocal, ReadSessionLocal
+from models import Feedback, User, Service, Schedule, Booking, Staff, DEFAULT_SERVICE_DURATION
 from states import (
     CreateScheduleStates, 
     AddServiceStates, 
@@ -22,13 +20,17 @@ from states import (
 )
 from keyboards import (
     get_admin_keyboard, 
+    get_back_keyboard,
     get_cancel_keyboard,
     get_days_keyboard_for_month,
     get_months_keyboard, 
     get_services_keyboard,
-    get_client_keyboard, 
-    get_confirm_keyboard
+    get_client_keyboard
 )
+from broadcasts import enqueue_broadcast
+from statements import SERVICE_BY_NAME, BOOKINGS_IN_RANGE
+from rendering import answer_chunked
+from invalidation import invalidation_bus, TOPIC_SERVICES, TOPIC_SCHEDULE
 from config import ADMIN_ID
 
 logger = logging.getLogger(__name__)
@@ -43,6 +45,13 @@ def parse_time_slot(time_str: str) -> Optional[Tuple[int, int]]:
     except ValueError:
         return None
 
+def parse_slot_capacity(slot_str: str) -> Tuple[str, int]:
+    """Разбирает время со счётчиком мест: 10:00x2 -> ('10:00', 2)"""
+    match = re.fullmatch(r'(\d{1,2}:\d{2})[xх](\d+)', slot_str)
+    if match:
+        return match.group(1), int(match.group(2))
+    return slot_str, 1
+
 def parse_date_part(date_str: str) -> Optional[Tuple[int, int, int]]:
     parts = date_str.split('.')
     current_year = datetime.now().year
@@ -64,6 +73,13 @@ def parse_date_part(date_str: str) -> Optional[Tuple[int, int, int]]:
     except (ValueError, IndexError):
         return None
 
+def parse_service_duration(description: str) -> Tuple[str, Optional[int]]:
+    """Отделяет длительность в конце описания: 'Окрашивание - 120 мин' -> ('Окрашивание', 120)"""
+    match = re.fullmatch(r'(.*?)\s*-\s*(\d+)\s*мин\.?', description)
+    if match:
+        return match.group(1).strip(), int(match.group(2))
+    return description, None
+
 def is_valid_date(date_str: str) -> bool:
     try:
         datetime.strptime(date_str, '%d.%m.%Y')
@@ -113,39 +129,39 @@ async def view_bookings_select_day(message: types.Message, state: FSMContext):
         await message.answer("Некорректный формат даты. Выберите день из списка.")
         return
     
-    async with SessionLocal() as session:
+    async with ReadSessionLocal() as session:
+        day_start = datetime.combine(day_date, datetime.min.time())
         bookings = await session.execute(
-            select(Booking, User, Service)
-            .join(User)
-            .join(Service)
-            .where(func.date(Booking.date) == day_date)
-            .order_by(Booking.date)
+            BOOKINGS_IN_RANGE, {"start": day_start, "end": day_start + timedelta(days=1)}
         )
         
         bookings = bookings.all()
         
-        response = f"📅 Записи на {day_date.strftime('%d.%m.%Y')}:\n\n"
         if not bookings:
-            response = f"На {day_date.strftime('%d.%m.%Y')} нет записей."
-        
-        for booking, user, service in bookings:
-            response += (
-                f"⏰ Время: {booking.date.strftime('%H:%M')}\n"
-                f"👤 Клиент: {user.first_name} {user.last_name}\n"
-                f"📱 Телефон: {user.phone}\n"
-                f"💈 Услуга: {service.name} ({service.price}₽)\n"
-                f"Статус: {'✅ Подтверждена' if booking.confirmed else '🕒 Ожидает подтверждения'}\n"
-                f"ID записи: {booking.id}\n"
-                f"━━━━━━━━━━━━━━━━━━\n"
+            await message.answer(
+                f"На {day_date.strftime('%d.%m.%Y')} нет записей.",
+                reply_markup=get_back_keyboard()
             )
+            return
         
-        # Клавиатура только с кнопкой "Назад"
-        back_keyboard = ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text="🔙 Назад")]],
-            resize_keyboard=True
+        blocks = (
+            f"⏰ Время: {booking.date.strftime('%H:%M')}\n"
+            f"👤 Клиент: {booking.first_name} {booking.last_name}\n"
+            f"📱 Телефон: {booking.phone}\n"
+            f"💈 Услуга: {booking.service_name} ({booking.price}₽)\n"
+            f"Статус: {'✅ Подтверждена' if booking.confirmed else '🕒 Ожидает подтверждения'}\n"
+            f"ID записи: {booking.id}\n"
+            f"━━━━━━━━━━━━━━━━━━\n"
+            for booking in bookings
         )
         
-        await message.answer(response, reply_markup=back_keyboard)
+        # Клавиатура только с кнопкой "Назад"
+        await answer_chunked(
+            message,
+            blocks,
+            header=f"📅 Записи на {day_date.strftime('%d.%m.%Y')}:\n\n",
+            reply_markup=get_back_keyboard()
+        )
 
 async def create_schedule_handler(message: types.Message, state: FSMContext):
     if message.from_user.id != ADMIN_ID:
@@ -156,7 +172,9 @@ async def create_schedule_handler(message: types.Message, state: FSMContext):
         "Введите даты и времена для создания расписания в формате:\n"
         "02.04 10:00 12:00 14:00 16:00 18:00\n"
         "03.04 10:00 12:00 14:00\n\n"
-        "Можно указывать даты в формате ДД.ММ или ДД.ММ.ГГГГ",
+        "Можно указывать даты в формате ДД.ММ или ДД.ММ.ГГГГ\n"
+        "Мастер указывается через @: @Анна 02.04 10:00 12:00\n"
+        "Несколько мест на одно время (только без мастера): 10:00x2",
         reply_markup=get_cancel_keyboard()
     )
     await state.set_state(CreateScheduleStates.waiting_for_dates)
@@ -169,11 +187,29 @@ async def create_schedule_process(message: types.Message, state: FSMContext):
     
     parts = [p.strip() for p in message.text.split() if p.strip()]
     current_date = None
+    current_staff_id = None
     created_slots = 0
     errors = []
     
     async with SessionLocal() as session:
         for part in parts:
+            # Выбор мастера для последующих слотов
+            if part.startswith('@'):
+                staff_name = part[1:]
+                if not staff_name:
+                    errors.append(f"Не указано имя мастера: {part}")
+                    continue
+                staff = await session.execute(
+                    select(Staff).where(Staff.name == staff_name)
+                )
+                staff = staff.scalars().first()
+                if not staff:
+                    staff = Staff(name=staff_name)
+                    session.add(staff)
+                    await session.flush()
+                current_staff_id = staff.id
+                continue
+            
             # Убедитесь, что даты парсятся правильно
             date_parts = parse_date_part(part)
             if date_parts:
@@ -189,12 +225,19 @@ async def create_schedule_process(message: types.Message, state: FSMContext):
                     errors.append(f"Некорректная дата: {part} ({str(e)})")
                     continue
             
-            time_parts = parse_time_slot(part)
+            time_str, capacity = parse_slot_capacity(part)
+            time_parts = parse_time_slot(time_str)
             if time_parts:
                 if current_date is None:
                     errors.append(f"Сначала укажите дату перед временем: {part}")
                     continue
                 
+                # Мастер обслуживает одного клиента за раз: пересечение его
+                # записей запрещает ограничение ex_bookings_staff_overlap
+                if current_staff_id and capacity > 1:
+                    errors.append(f"У мастера может быть только одно место на время: {part}")
+                    continue
+                
                 hour, minute = time_parts
                 try:
                     slot_datetime = current_date.replace(hour=hour, minute=minute)
@@ -204,10 +247,18 @@ async def create_schedule_process(message: types.Message, state: FSMContext):
                         continue
                     
                     existing = await session.execute(
-                        select(Schedule).where(Schedule.date == slot_datetime)
+                        select(Schedule).where(
+                            Schedule.date == slot_datetime,
+                            Schedule.staff_id == current_staff_id
+                            if current_staff_id else Schedule.staff_id.is_(None)
+                        )
                     )
                     if not existing.scalar():
-                        session.add(Schedule(date=slot_datetime))
+                        session.add(Schedule(
+                            date=slot_datetime,
+                            staff_id=current_staff_id,
+                            capacity=capacity
+                        ))
                         created_slots += 1
                 except ValueError as e:
                     errors.append(f"Ошибка времени {part}: {str(e)}")
@@ -217,6 +268,8 @@ async def create_schedule_process(message: types.Message, state: FSMContext):
                 continue
         
         await session.commit()
+    if created_slots:
+        invalidation_bus.publish(TOPIC_SCHEDULE)
     
     response = []
     if created_slots > 0:
@@ -240,8 +293,9 @@ async def add_service_handler(message: types.Message, state: FSMContext):
     
     await message.answer(
         "Введите данные услуги в формате:\n"
-        "Название услуги - Цена - Описание\n"
-        "Например: Стрижка - 1000 - Мужская стрижка",
+        "Название услуги - Цена - Описание - Длительность\n"
+        "Например: Стрижка - 1000 - Мужская стрижка - 60 мин\n"
+        "Если длительность не указана, она считается равной 60 минутам",
         reply_markup=get_cancel_keyboard()
     )
     await state.set_state(AddServiceStates.waiting_for_data)
@@ -254,9 +308,16 @@ async def process_add_service(message: types.Message, state: FSMContext):
     
     try:
         name, price, description = map(str.strip, message.text.split('-', 2))
+        description, duration = parse_service_duration(description)
         async with SessionLocal() as session:
-            session.add(Service(name=name, price=price, description=description))
+            session.add(Service(
+                name=name,
+                price=price,
+                description=description,
+                duration=duration or DEFAULT_SERVICE_DURATION
+            ))
             await session.commit()
+        invalidation_bus.publish(TOPIC_SERVICES)
         await message.answer(
             f"Услуга '{name}' успешно добавлена!",
             reply_markup=get_admin_keyboard()
@@ -296,7 +357,8 @@ async def select_service_to_edit(message: types.Message, state: FSMContext):
     await state.update_data(service_name=service_name)
     await message.answer(
         f"Введите новые данные для услуги '{service_name}' в формате:\n"
-        "Новое название - Новая цена - Новое описание\n",
+        "Новое название - Новая цена - Новое описание - Длительность\n"
+        "Длительность указывается в минутах (например, 90 мин) и может быть опущена\n",
         reply_markup=get_cancel_keyboard()
     )
     await state.set_state(EditServiceStates.waiting_for_new_data)
@@ -312,7 +374,7 @@ async def process_edit_service(message: types.Message, state: FSMContext):
     
     async with SessionLocal() as session:
         service = await session.execute(
-            select(Service).where(Service.name == service_name)
+            SERVICE_BY_NAME, {"name": service_name}
         )
         service = service.scalars().first()
         
@@ -323,6 +385,7 @@ async def process_edit_service(message: types.Message, state: FSMContext):
         
         try:
             new_name, new_price, new_description = map(str.strip, message.text.split('-', 2))
+            new_description, new_duration = parse_service_duration(new_description)
             
             if new_name != '-':
                 service.name = new_name
@@ -330,13 +393,17 @@ async def process_edit_service(message: types.Message, state: FSMContext):
                 service.price = new_price
             if new_description != '-':
                 service.description = new_description
+            if new_duration:
+                service.duration = new_duration
             
             await session.commit()
+            invalidation_bus.publish(TOPIC_SERVICES)
             await message.answer(
                 f"Услуга успешно обновлена!\n"
                 f"Название: {service.name}\n"
                 f"Цена: {service.price}\n"
-                f"Описание: {service.description}",
+                f"Описание: {service.description}\n"
+                f"Длительность: {service.duration} мин",
                 reply_markup=get_admin_keyboard()
             )
         except Exception as e:
@@ -374,7 +441,7 @@ async def delete_service_confirm(message: types.Message, state: FSMContext):
     
     async with SessionLocal() as session:
         service = await session.execute(
-            select(Service).where(Service.name == service_name)
+            SERVICE_BY_NAME, {"name": service_name}
         )
         service = service.scalars().first()
         
@@ -398,6 +465,7 @@ async def delete_service_confirm(message: types.Message, state: FSMContext):
         
         await session.delete(service)
         await session.commit()
+    invalidation_bus.publish(TOPIC_SERVICES)
     
     await state.clear()
     await message.answer(
@@ -405,65 +473,30 @@ async def delete_service_confirm(message: types.Message, state: FSMContext):
         reply_markup=get_admin_keyboard()
     )
 
-async def start_broadcast(message: types.Message, state: FSMContext):
-    """Начало процесса рассылки"""
-    if message.from_user.id != ADMIN_ID:  # ADMIN_ID должен быть определен в конфигурации
-        return
-    
-    await message.answer(
-        "✉️ Введите сообщение для рассылки:",
-        reply_markup=types.ReplyKeyboardRemove()
-    )
-    await state.set_state(AdminStates.waiting_for_broadcast_message)
-
-async def process_broadcast_message(message: types.Message, state: FSMContext, bot: Bot):
-    """Обработка сообщения для рассылки"""
+async def process_broadcast_message(message: types.Message, state: FSMContext):
+    """Обработка сообщения для рассылки: рассылку выполняет воркер, обработчик только ставит её в очередь"""
     if message.text == "❌ Отмена":
         await state.clear()
         await message.answer("Рассылка отменена", reply_markup=get_admin_keyboard())
         return
     
-    data = await state.get_data()
-    start_time = data.get('start_time', datetime.now())
-    
     try:
         async with SessionLocal() as session:
-            users = await session.execute(
-                select(User.telegram_id).where(User.telegram_id != str(ADMIN_ID))
+            job = enqueue_broadcast(
+                session,
+                message.html_text if hasattr(message, 'html_text') else message.text,
+                requested_by=message.from_user.id
             )
-            users = users.scalars().all()
-        
-        success = 0
-        failed = []
-        
-        for user_id in users:
-            try:
-                await bot.send_message(
-                    chat_id=int(user_id),
-                    text=message.html_text if hasattr(message, 'html_text') else message.text,
-                    parse_mode="HTML"
-                )
-                success += 1
-                await asyncio.sleep(0.1)  # Защита от лимитов Telegram
-            except Exception as e:
-                failed.append(str(user_id))
-                logger.warning(f"Не удалось отправить сообщение {user_id}: {e}")
-        
-        time_spent = (datetime.now() - start_time).total_seconds()
+            await session.commit()
         
-        report = (
-            f"📊 Результаты рассылки\n\n"
-            f"• Получателей: {len(users)}\n"
-            f"• Успешно: {success}\n"
-            f"• Ошибки: {len(failed)}\n"
-            f"• Время: {time_spent:.2f} сек.\n\n"
-            f"Первые 10 ID с ошибками:\n{', '.join(failed[:10])}{'...' if len(failed) > 10 else ''}"
+        await message.answer(
+            f"📨 Рассылка №{job.id} поставлена в очередь.\n"
+            "Отчёт придёт после её завершения.",
+            reply_markup=get_admin_keyboard()
         )
-        
-        await message.answer(report, reply_markup=get_admin_keyboard())
     
     except Exception as e:
-        logger.error(f"Ошибка рассылки: {e}", exc_info=True)
+        logger.error("Ошибка рассылки: %s", e, exc_info=True)
         await message.answer(f"❌ Критическая ошибка: {str(e)}", reply_markup=get_admin_keyboard())
     
     finally:
@@ -484,89 +517,66 @@ async def broadcast_handler(message: types.Message, state: FSMContext):
     )
     await state.set_state(AdminStates.waiting_for_broadcast_message)
 
-async def broadcast_send(message: types.Message, state: FSMContext):
-    bot = message.bot
-    
-    if message.text == "❌ Отмена":
-        await state.clear()
-        await message.answer("Рассылка отменена", reply_markup=get_admin_keyboard())
-        return
-    
-    async with SessionLocal() as session:
-        users = await session.execute(select(User))
-        users = users.scalars().all()
-        
-        success = 0
-        failed = 0
-        
-        for user in users:
-            try:
-                await bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=f"📢 Сообщение от администратора:\n\n{message.text}"
-                )
-                success += 1
-            except Exception as e:
-                logger.error(f"Ошибка при отправке сообщения пользователю {user.id}: {e}")
-                failed += 1
-    
-    await state.clear()
-    await message.answer(
-        f"Рассылка завершена:\nУспешно: {success}\nНе удалось: {failed}",
-        reply_markup=get_admin_keyboard()
-    )
-
 async def view_schedule_handler(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("Эта функция доступна только администратору")
         return
     
-    async with SessionLocal() as session:
-        dates = await session.execute(
-            select(Schedule.date)
+    async with ReadSessionLocal() as session:
+        slots = await session.execute(
+            select(Schedule.date, Schedule.capacity, Staff.name)
+            .outerjoin(Staff)
             .where(Schedule.date >= datetime.now())
             .order_by(Schedule.date)
         )
         
-        dates = dates.scalars().all()
+        slots = slots.all()
         
-        if not dates:
+        if not slots:
             await message.answer("Расписание не создано или все слоты уже прошли")
             return
         
         schedule_by_date = {}
-        for slot in dates:
-            date_str = slot.strftime('%d.%m.%Y')
-            time_str = slot.strftime('%H:%M')
+        for slot_date, capacity, staff_name in slots:
+            date_str = slot_date.strftime('%d.%m.%Y')
+            time_str = slot_date.strftime('%H:%M')
+            if staff_name:
+                time_str += f" ({staff_name})"
+            if capacity > 1:
+                time_str += f" x{capacity}"
             if date_str not in schedule_by_date:
                 schedule_by_date[date_str] = []
             schedule_by_date[date_str].append(time_str)
         
-        response = "📅 Текущее расписание:\n\n"
-        for date, times in schedule_by_date.items():
-            response += f"📅 <b>{date}</b>:\n"
-            for time in sorted(times):
-                response += f"  - {time}\n"
-            response += "\n"
+        blocks = (
+            f"📅 <b>{date}</b>:\n" + "".join(f"  - {html.escape(time)}\n" for time in sorted(times)) + "\n"
+            for date, times in schedule_by_date.items()
+        )
         
-        booked_slots = await session.execute(
-            select(Booking.date)
+        booked_count = await session.execute(
+            select(func.count(Booking.id))
             .where(Booking.date >= datetime.now(), Booking.confirmed == True)
         )
-        booked_slots = {slot.strftime('%d.%m.%Y %H:%M') for slot in booked_slots.scalars()}
+        booked_count = booked_count.scalar()
         
-        total_slots = len(dates)
-        booked_count = len(booked_slots)
+        # Слот с несколькими местами учитывается по числу мест
+        total_slots = sum(capacity for _, capacity, _ in slots)
         free_slots = total_slots - booked_count
         
-        response += (
+        stats = (
             f"\nℹ️ <b>Статистика:</b>\n"
             f"Всего слотов: {total_slots}\n"
             f"Забронировано: {booked_count}\n"
             f"Свободно: {free_slots}"
         )
         
-        await message.answer(response, parse_mode='HTML')
+        await answer_chunked(
+            message,
+            blocks,
+            header="📅 Текущее расписание:\n\n",
+            footer=stats,
+            parse_mode='HTML'
+        )
 
 async def client_functions_handler(message: types.Message):
     if message.from_user.id != ADMIN_ID:
@@ -583,7 +593,7 @@ async def view_feedbacks_handler(message: types.Message):
         await message.answer("Эта функция доступна только администратору")
         return
 
-    async with SessionLocal() as session:
+    async with ReadSessionLocal() as session:
         try:
             feedbacks = await session.execute(
                 select(Feedback, User)
@@ -592,22 +602,23 @@ async def view_feedbacks_handler(message: types.Message):
                 .limit(10)
             )
             
+            feedbacks = feedbacks.all()
             if not feedbacks:
                 await message.answer("Пока нет отзывов")
                 return
                 
-            response = "📝 Последние отзывы:\n\n"
-            for feedback, user in feedbacks:
-                response += (
-                    f"👤 {user.first_name} {user.last_name}\n"
-                    f"⭐ Оценка: {feedback.rating}/5\n"
-                    f"📄 Текст: {feedback.text}\n"
-                    f"📅 Дата: {feedback.created_at.strftime('%d.%m.%Y %H:%M')}\n"
-                    f"━━━━━━━━━━━━━━━━━━\n"
-                )
+            # Текст отзыва и имя вводит пользователь - экранируем для HTML
+            blocks = (
+                f"👤 {html.escape(user.first_name)} {html.escape(user.last_name)}\n"
+                f"⭐ Оценка: {feedback.rating}/5\n"
+                f"📄 Текст: {html.escape(feedback.text or '')}\n"
+                f"📅 Дата: {feedback.created_at.strftime('%d.%m.%Y %H:%M')}\n"
+                f"━━━━━━━━━━━━━━━━━━\n"
+                for feedback, user in feedbacks
+            )
             
-            await message.answer(response, parse_mode="HTML")
+            await answer_chunked(message, blocks, header="📝 Последние отзывы:\n\n", parse_mode="HTML")
             
         except Exception as e:
-            logging.error(f"Error fetching feedbacks: {e}")
+            logging.error("Error fetching feedbacks: %s", e)
             await message.answer("Ошибка при получении отзывов")
\ No newline at end of file
@@ -1,20 +1,19 @@
 # handlers/user.py
-from email import message
+import html
 import re
 import logging
 from datetime import datetime, timedelta
-import stat
-from aiogram import Bot, types
+from typing import Optional
+from aiogram import types
 from aiogram.fsm.context import FSMContext
-from sqlalchemy import select, func, and_, exists
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
-from sqlalchemy.ext.asyncio import AsyncSession
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
 
 from states import FeedbackStates
 from database import SessionLocal
-from models import Feedback, User, Service, Booking, Schedule
+from models import Feedback, User, Service, Booking, Schedule, DEFAULT_SERVICE_DURATION
 from states import (
     RegistrationStates, BookingStates,
     RescheduleStates, CancelStates
@@ -22,8 +21,23 @@ from states import (
 from keyboards import (
     get_client_keyboard, get_admin_keyboard,
     get_cancel_keyboard, get_months_keyboard, get_services_keyboard,
-    get_days_keyboard_for_month, get_times_keyboard,
-    get_confirm_keyboard, get_user_bookings_keyboard,
+    get_days_keyboard_for_month, get_times_keyboard, get_offered_times,
+    get_time_confirm_keyboard,
+    get_user_bookings_keyboard,
+    get_cancel_confirm_keyboard, cached_reply_keyboard,
+)
+from slots import find_free_slot, overlapping_bookings_query
+from statements import USER_BY_TELEGRAM_ID, USER_ID_BY_TELEGRAM_ID, SERVICE_BY_NAME
+from audit import record_event, EVENT_CREATED, EVENT_RESCHEDULED, EVENT_CANCELLED
+from reminders import schedule_reminders
+import booking_moves
+from booking_moves import move_booking
+from slot_holds import slot_holds
+from rendering import answer_chunked
+from bookings_cache import upcoming_bookings, bookings_changed
+from quotas import (
+    ACTION_CANCEL, ACTION_RESCHEDULE, MONTHLY_LIMITS,
+    can_perform_action, consume_quota
 )
 from config import ADMIN_ID
 
@@ -59,7 +73,7 @@ async def start_handler(message: types.Message, state: FSMContext):
     
     async with SessionLocal() as session:
         user = await session.execute(
-            select(User).where(User.telegram_id == str(message.from_user.id))
+            USER_BY_TELEGRAM_ID, {"telegram_id": str(message.from_user.id)}
         )
         user = user.scalars().first()
         
@@ -133,14 +147,18 @@ async def select_service(message: types.Message, state: FSMContext):
         return
     
     async with SessionLocal() as session:
-        service = await session.execute(select(Service).where(Service.name == service_name))
+        service = await session.execute(SERVICE_BY_NAME, {"name": service_name})
         service = service.scalars().first()
         
         if not service:
             await message.answer("Услуга не найдена, попробуйте ещё раз")
             return
         
-        await state.update_data(service_id=service.id, service_name=service.name)
+        await state.update_data(
+            service_id=service.id,
+            service_name=service.name,
+            service_duration=service.duration
+        )
         await message.answer(
             "Выберите месяц:",
             reply_markup=await get_months_keyboard()
@@ -178,126 +196,195 @@ async def select_day(message: types.Message, state: FSMContext):
         return
     
     await state.update_data(day=message.text)
+    data = await state.get_data()
     await message.answer(
         "Выберите время:",
-        reply_markup=await get_times_keyboard(message.text)
+        reply_markup=await get_times_keyboard(
+            message.text,
+            duration=data.get('service_duration', DEFAULT_SERVICE_DURATION),
+            telegram_id=message.from_user.id
+        )
     )
     await state.set_state(BookingStates.waiting_for_time)
 
+def full_day(day: str) -> str:
+    """День в формате ДД.ММ.ГГГГ: при переносе год может быть не указан"""
+    return day if len(day.split('.')) == 3 else f"{day}.{datetime.now().year}"
+
+async def answer_time_taken(message: types.Message, data: dict):
+    """Время заняли параллельно: сразу показываем свободное время того же дня,
+    чтобы не проходить выбор услуги, месяца и дня заново"""
+    await message.answer(
+        "Это время уже занято, выберите другое",
+        reply_markup=await get_times_keyboard(
+            full_day(data['day']),
+            exclude_booking_id=data.get('booking_id'),
+            duration=data.get('service_duration', DEFAULT_SERVICE_DURATION),
+            telegram_id=message.from_user.id
+        )
+    )
+
+async def hold_selected_time(message: types.Message, data: dict) -> Optional[datetime]:
+    """Закрепляет выбранное время за пользователем до подтверждения.
+
+    Пока пользователь подтверждает, другие этого времени не видят (см. slot_holds).
+    Возвращает выбранное время или None, если его уже заняли или закрепили за другим.
+    """
+    day = full_day(data['day'])
+    selected_datetime = datetime.strptime(f"{day} {message.text}", '%d.%m.%Y %H:%M')
+    duration = data.get('service_duration', DEFAULT_SERVICE_DURATION)
+    offered = await get_offered_times(
+        day,
+        exclude_booking_id=data.get('booking_id'),
+        duration=duration,
+        telegram_id=message.from_user.id
+    )
+    if not offered or selected_datetime not in offered:
+        await answer_time_taken(message, data)
+        return None
+    slot_holds.hold(message.from_user.id, selected_datetime, duration, offered[selected_datetime])
+    return selected_datetime
+
 async def select_time(message: types.Message, state: FSMContext):
-    try:
-        if message.text == "🔙 Назад":
-            data = await state.get_data()
-            await message.answer(
-                "Выберите день:",
-                reply_markup=await get_days_keyboard_for_month(data['month'])
-            )
-            await state.set_state(BookingStates.waiting_for_day)
-            return
-        
-        if not is_valid_time(message.text):
-            await message.answer("Некорректный формат времени. Выберите время из списка.")
-            return
-        
+    if message.text == "🔙 Назад":
         data = await state.get_data()
+        await message.answer(
+            "Выберите день:",
+            reply_markup=await get_days_keyboard_for_month(data['month'])
+        )
+        await state.set_state(BookingStates.waiting_for_day)
+        return
+    
+    if not is_valid_time(message.text):
+        await message.answer("Некорректный формат времени. Выберите время из списка.")
+        return
+    
+    data = await state.get_data()
+    selected_datetime = await hold_selected_time(message, data)
+    if not selected_datetime:
+        return
+    
+    await state.update_data(time=message.text)
+    await message.answer(
+        f"Запись на {data['service_name']}\n"
+        f"📅 Дата и время: {selected_datetime.strftime('%d.%m.%Y %H:%M')}\n"
+        f"Время закреплено за вами на {int(slot_holds.ttl)} сек. Подтвердите запись:",
+        reply_markup=get_time_confirm_keyboard()
+    )
+    await state.set_state(BookingStates.waiting_for_confirmation)
+
+async def confirm_booking(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    
+    if message.text == "🔙 Назад":
+        slot_holds.release(message.from_user.id)
+        await message.answer(
+            "Выберите время:",
+            reply_markup=await get_times_keyboard(
+                data['day'],
+                duration=data.get('service_duration', DEFAULT_SERVICE_DURATION),
+                telegram_id=message.from_user.id
+            )
+        )
+        await state.set_state(BookingStates.waiting_for_time)
+        return
+    
+    if message.text != "✅ Подтвердить":
+        await message.answer("Подтвердите запись или вернитесь назад")
+        return
+    
+    try:
         selected_datetime = datetime.strptime(
-            f"{data['day']} {message.text}", '%d.%m.%Y %H:%M'
+            f"{data['day']} {data['time']}", '%d.%m.%Y %H:%M'
         )
         
         async with SessionLocal() as session:
             async with session.begin():  # Явное управление транзакцией
-                schedule_slot = await session.execute(
-                    select(Schedule)
-                    .where(Schedule.date == selected_datetime)
-                    .with_for_update()  # Блокируем запись для обновления
+                # Блокируем слоты всех мастеров на время услуги и ищем, куда она помещается
+                duration = data.get('service_duration', DEFAULT_SERVICE_DURATION)
+                slot_exists, schedule_slot = await find_free_slot(
+                    session, selected_datetime, duration,
+                    preferred_staff_id=slot_holds.held_staff(message.from_user.id)
                 )
-                schedule_slot = schedule_slot.scalars().first()
                 
-                if not schedule_slot:
+                if not slot_exists:
                     await message.answer("Это время больше не доступно")
                     return
                 
-                existing_booking = await session.execute(
-                    select(Booking)
-                    .where(
-                        Booking.schedule_id == schedule_slot.id,
-                        Booking.confirmed == True
-                    )
-                )
-                
-                if existing_booking.scalars().first():
-                    await message.answer("Это время уже занято, выберите другое")
+                if not schedule_slot:
+                    await answer_time_taken(message, data)
+                    await state.set_state(BookingStates.waiting_for_time)
                     return
                 
                 user = await session.execute(
-                    select(User).where(User.telegram_id == str(message.from_user.id))
+                    USER_BY_TELEGRAM_ID, {"telegram_id": str(message.from_user.id)}
                 )
                 user = user.scalars().first()
                 
                 booking = Booking(
                     date=selected_datetime,
+                    end_date=selected_datetime + timedelta(minutes=duration),
                     user_id=user.id,
                     service_id=data['service_id'],
                     confirmed=True,
-                    schedule_id=schedule_slot.id
+                    schedule_id=schedule_slot.id,
+                    staff_id=schedule_slot.staff_id
                 )
                 session.add(booking)
-                
-                await message.answer(
-                    f"✅ Вы успешно записаны на {data['service_name']}!\n"
-                    f"📅 Дата и время: {selected_datetime.strftime('%d.%m.%Y %H:%M')}",
-                    reply_markup=get_client_keyboard()
-                )
+                await session.flush()
+                schedule_reminders(session, booking.id, booking.date)
             
+            # Сообщаем об успехе только после коммита: ограничение на пересечение
+            # интервалов может отклонить запись при фиксации транзакции
+            bookings_changed(message.from_user.id)
+            record_event(
+                EVENT_CREATED, booking.id, booking.user_id, message.from_user.id,
+                booking.date, service_id=booking.service_id, staff_id=booking.staff_id
+            )
+            await message.answer(
+                f"✅ Вы успешно записаны на {data['service_name']}!\n"
+                f"📅 Дата и время: {selected_datetime.strftime('%d.%m.%Y %H:%M')}",
+                reply_markup=get_client_keyboard()
+            )
             await state.clear()
             
+    except IntegrityError:
+        await answer_time_taken(message, data)
+        await state.set_state(BookingStates.waiting_for_time)
     except Exception as e:
-        logger.error(f"Ошибка при создании записи: {str(e)}", exc_info=True)
+        logger.error("Ошибка при создании записи: %s", e, exc_info=True)
         await message.answer("Произошла ошибка при обработке вашей записи. Пожалуйста, попробуйте позже.")
+    finally:
+        # Запись создана или не удалась - удержание больше не нужно
+        slot_holds.release(message.from_user.id)
 
 async def my_bookings_handler(message: types.Message):
-    async with SessionLocal() as session:
-        user = await session.execute(
-            select(User).where(User.telegram_id == str(message.from_user.id))
-        )
-        user = user.scalars().first()
-        
-        if not user:
-            await message.answer("Ошибка: пользователь не найден")
-            return
-        
-        bookings = await session.execute(
-            select(Booking, Service)
-            .join(Service)
-            .where(
-                Booking.user_id == user.id,
-                Booking.date >= datetime.now()
-            )
-            .order_by(Booking.date)
-        )
-        
-        bookings = bookings.all()
-        
-        if not bookings:
-            await message.answer("У вас нет активных записей", reply_markup=get_client_keyboard())
-            return
-        
-        response = "📋 <b>Ваши активные записи:</b>\n\n"
-        for booking, service in bookings:
-            status = "✅ Подтверждена" if booking.confirmed else "🕒 Ожидает подтверждения"
-            response += (
-                f"<b>🔹 Услуга:</b> {service.name}\n"
-                f"<b>📅 Дата и время:</b> {booking.date.strftime('%d.%m.%Y %H:%M')}\n"
-                f"<b>Статус:</b> {status}\n"
-                f"<b>ID записи:</b> {booking.id}\n"
-                f"━━━━━━━━━━━━━━━━━━\n"
-            )
-        
-        await message.answer(
-            response,
-            reply_markup=get_client_keyboard(),
-            parse_mode='HTML'
-        )
+    bookings = await upcoming_bookings.get(message.from_user.id)
+    
+    if bookings is None:
+        await message.answer("Ошибка: пользователь не найден")
+        return
+    
+    if not bookings:
+        await message.answer("У вас нет активных записей", reply_markup=get_client_keyboard())
+        return
+    
+    blocks = (
+        f"<b>🔹 Услуга:</b> {html.escape(booking.service_name)}\n"
+        f"<b>📅 Дата и время:</b> {booking.date.strftime('%d.%m.%Y %H:%M')}\n"
+        f"<b>Статус:</b> {'✅ Подтверждена' if booking.confirmed else '🕒 Ожидает подтверждения'}\n"
+        f"<b>ID записи:</b> {booking.id}\n"
+        f"━━━━━━━━━━━━━━━━━━\n"
+        for booking in bookings
+    )
+    
+    await answer_chunked(
+        message,
+        blocks,
+        header="📋 <b>Ваши активные записи:</b>\n\n",
+        reply_markup=get_client_keyboard(),
+        parse_mode='HTML'
+    )
 
 async def process_booking_actions(callback_query: types.CallbackQuery, state: FSMContext):
     """Обработчик действий с записями (перенос/отмена)"""
@@ -323,7 +410,8 @@ async def process_booking_actions(callback_query: types.CallbackQuery, state: FS
             
             await state.update_data(
                 booking_id=booking.id,
-                service_id=booking.service_id
+                service_id=booking.service_id,
+                service_duration=service.duration
             )
             await callback_query.message.answer(
                 "Выберите новый месяц для записи:",
@@ -372,6 +460,11 @@ async def process_cancel_confirmation(callback_query: types.CallbackQuery, state
             # Вместо удаления просто помечаем как отмененную
             booking.confirmed = False
             await session.commit()
+            bookings_changed(callback_query.from_user.id)
+            record_event(
+                EVENT_CANCELLED, booking.id, booking.user_id,
+                callback_query.from_user.id, booking.date
+            )
 
 async def process_rebooking(callback_query: types.CallbackQuery, state: FSMContext):
     service_id = int(callback_query.data.split('_')[1])
@@ -381,7 +474,8 @@ async def process_rebooking(callback_query: types.CallbackQuery, state: FSMConte
         if service:
             await state.update_data(
                 service_id=service.id,
-                service_name=service.name
+                service_name=service.name,
+                service_duration=service.duration
             )
             await callback_query.message.answer(
                 "Выберите новый месяц для записи:",
@@ -391,41 +485,20 @@ async def process_rebooking(callback_query: types.CallbackQuery, state: FSMConte
     
     await callback_query.answer()
 
-async def can_perform_action(user: User, action_type: str) -> bool:
-    """Проверяет, может ли пользователь выполнить действие"""
-    current_month = datetime.now().month
-    
-    # Если действие в новом месяце - сбрасываем счетчики
-    if user.last_action_month != current_month:
-        user.reschedules_this_month = 0
-        user.cancels_this_month = 0
-        user.last_action_month = current_month
-        return True
-    
-    if action_type == 'reschedule':
-        return user.reschedules_this_month < 1
-    elif action_type == 'cancel':
-        return user.cancels_this_month < 1
-    return False
+async def get_user_id(session, telegram_id: int):
+    user_id = await session.execute(USER_ID_BY_TELEGRAM_ID, {"telegram_id": str(telegram_id)})
+    return user_id.scalar()
 
 async def reschedule_handler(message: types.Message, state: FSMContext):
     """Обработчик кнопки 'Перенести запись'"""
+    limit = MONTHLY_LIMITS[ACTION_RESCHEDULE]
     async with SessionLocal() as session:
-        user = await session.execute(
-            select(User).where(User.telegram_id == str(message.from_user.id))
-        )
-        user = user.scalars().first()
-        
-        current_month = datetime.now().month
-        if user.last_action_month != current_month:
-            user.reschedules_this_month = 0
-            user.last_action_month = current_month
-            await session.commit()
+        user_id = await get_user_id(session, message.from_user.id)
         
         # Если лимит исчерпан - сразу сообщаем
-        if user.reschedules_this_month >= 1:
+        if not user_id or not await can_perform_action(session, user_id, ACTION_RESCHEDULE):
             await message.answer(
-                "❌ Лимит переносов на этот месяц исчерпан (1/1)",
+                f"❌ Лимит переносов на этот месяц исчерпан ({limit}/{limit})",
                 reply_markup=get_client_keyboard()
             )
             return
@@ -438,7 +511,7 @@ async def reschedule_handler(message: types.Message, state: FSMContext):
             return
         
         await message.answer(
-            "Вы можете перенести запись только 1 раз в месяц\n"
+            f"Переносов записи в месяц: не более {limit}\n"
             "Выберите запись для переноса:",
             reply_markup=keyboard
         )
@@ -459,12 +532,9 @@ async def process_reschedule_confirmation(message: types.Message, state: FSMCont
         return
     
     async with SessionLocal() as session:
-        user = await session.execute(
-            select(User).where(User.telegram_id == str(message.from_user.id))
-        )
-        user = user.scalars().first()
+        user_id = await get_user_id(session, message.from_user.id)
         
-        if user.reschedules_this_month >= 1:
+        if not user_id or not await can_perform_action(session, user_id, ACTION_RESCHEDULE):
             await message.answer(
                 "Вы уже использовали свой лимит переносов в этом месяце",
                 reply_markup=get_client_keyboard()
@@ -516,6 +586,7 @@ async def reschedule_select_booking(message: types.Message, state: FSMContext):
             booking_id=booking.id,
             service_id=booking.service.id,
             service_name=booking.service.name,
+            service_duration=booking.service.duration,
             old_date=booking.date
         )
         
@@ -555,9 +626,15 @@ async def reschedule_new_day(message: types.Message, state: FSMContext):
         return
     
     await state.update_data(day=message.text)
+    data = await state.get_data()
     await message.answer(
         "Выберите время для переноса:",
-        reply_markup=await get_times_keyboard(message.text)
+        reply_markup=await get_times_keyboard(
+            message.text,
+            exclude_booking_id=data.get('booking_id'),
+            duration=data.get('service_duration', DEFAULT_SERVICE_DURATION),
+            telegram_id=message.from_user.id
+        )
     )
     await state.set_state(RescheduleStates.waiting_for_new_time)  
 
@@ -576,135 +653,125 @@ async def reschedule_new_time(message: types.Message, state: FSMContext):
         return
     
     data = await state.get_data()
+    new_datetime = await hold_selected_time(message, data)
+    if not new_datetime:
+        return
     
-    async with SessionLocal() as session:
-        try:
-            # Получаем данные о переносимой записи
-            old_booking = await session.get(Booking, data['booking_id'])
-            if not old_booking:
-                await message.answer("Ошибка: запись не найдена")
-                await state.clear()
-                return
-
-            # Формируем новую дату
-            day_str = data['day'] if len(data['day'].split('.')) == 3 else f"{data['day']}.{datetime.now().year}"
-            new_datetime = datetime.strptime(f"{day_str} {message.text}", '%d.%m.%Y %H:%M')
+    await state.update_data(time=message.text)
+    await message.answer(
+        f"Перенести запись на {new_datetime.strftime('%d.%m.%Y %H:%M')}?\n"
+        f"Время закреплено за вами на {int(slot_holds.ttl)} сек.",
+        reply_markup=get_time_confirm_keyboard()
+    )
+    await state.set_state(RescheduleStates.waiting_for_confirmation)
 
-            # Проверяем новый слот
-            new_schedule_slot = await session.execute(
-                select(Schedule)
-                .where(Schedule.date == new_datetime)
+async def reschedule_confirm(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    
+    if message.text == "🔙 Назад":
+        slot_holds.release(message.from_user.id)
+        await message.answer(
+            "Выберите время для переноса:",
+            reply_markup=await get_times_keyboard(
+                full_day(data['day']),
+                exclude_booking_id=data.get('booking_id'),
+                duration=data.get('service_duration', DEFAULT_SERVICE_DURATION),
+                telegram_id=message.from_user.id
             )
-            new_schedule_slot = new_schedule_slot.scalars().first()
-            
-            if not new_schedule_slot:
-                await message.answer("Это время больше не доступно")
-                return
+        )
+        await state.set_state(RescheduleStates.waiting_for_new_time)
+        return
+    
+    if message.text != "✅ Подтвердить":
+        await message.answer("Подтвердите перенос или вернитесь назад")
+        return
 
-            # Проверяем, что новый слот свободен
-            existing_booking = await session.execute(
-                select(Booking)
-                .where(
-                    Booking.schedule_id == new_schedule_slot.id,
-                    Booking.confirmed == True
-                )
-            )
-            
-            if existing_booking.scalars().first():
-                await message.answer("Это время уже занято, выберите другое")
-                return
+    try:
+        new_datetime = datetime.strptime(f"{full_day(data['day'])} {data['time']}", '%d.%m.%Y %H:%M')
+        duration = data.get('service_duration', DEFAULT_SERVICE_DURATION)
+
+        # Слот, лимит и сама запись меняются в одной транзакции одним
+        # условным UPDATE; при гонке перенос повторяется с новыми данными
+        status, old_booking = await move_booking(
+            data['booking_id'], new_datetime, duration,
+            preferred_staff_id=slot_holds.held_staff(message.from_user.id)
+        )
+    except Exception as e:
+        logger.error("Ошибка при переносе записи: %s", e)
+        await message.answer(
+            "Произошла ошибка при переносе записи. Пожалуйста, попробуйте позже."
+        )
+        return
+    finally:
+        # Перенос выполнен или не удался - удержание больше не нужно
+        slot_holds.release(message.from_user.id)
 
-            # Удаляем старую запись (или помечаем как неактивную)
-            await session.delete(old_booking)
-            
-            # Создаем новую запись
-            new_booking = Booking(
-                date=new_datetime,
-                user_id=old_booking.user_id,
-                service_id=old_booking.service_id,
-                confirmed=True,
-                schedule_id=new_schedule_slot.id
-            )
-            session.add(new_booking)
-            
-            # Обновляем счетчик переносов у пользователя
-            user = await session.get(User, old_booking.user_id)
-            if user.last_action_month != datetime.now().month:
-                user.reschedules_this_month = 0
-                user.last_action_month = datetime.now().month
-            user.reschedules_this_month += 1
-            
-            await session.commit()
-            
-            await state.clear()
-            await message.answer(
-                f"✅ Запись успешно перенесена на {new_datetime.strftime('%d.%m.%Y %H:%M')}!",
-                reply_markup=get_client_keyboard()
-            )
-            
-        except Exception as e:
-            await session.rollback()
-            logger.error(f"Ошибка при переносе записи: {str(e)}")
-            await message.answer(
-                "Произошла ошибка при переносе записи. Пожалуйста, попробуйте позже."
-            )
+    if status == booking_moves.NOT_FOUND:
+        await message.answer("Ошибка: запись не найдена")
+        await state.clear()
+        return
+
+    if status == booking_moves.SLOT_MISSING:
+        await message.answer("Это время больше не доступно")
+        return
+
+    if status == booking_moves.SLOT_TAKEN:
+        await answer_time_taken(message, data)
+        await state.set_state(RescheduleStates.waiting_for_new_time)
+        return
+
+    if status == booking_moves.LIMIT_REACHED:
+        await message.answer(
+            "Вы уже использовали свой лимит переносов в этом месяце",
+            reply_markup=get_client_keyboard()
+        )
+        await state.clear()
+        return
+
+    bookings_changed(message.from_user.id)
+    record_event(
+        EVENT_RESCHEDULED, old_booking.id, old_booking.user_id, message.from_user.id,
+        new_datetime, previous_date=old_booking.date.isoformat()
+    )
+    await state.clear()
+    await message.answer(
+        f"✅ Запись успешно перенесена на {new_datetime.strftime('%d.%m.%Y %H:%M')}!",
+        reply_markup=get_client_keyboard()
+    )
 
 async def cancel_handler(message: types.Message, state: FSMContext):
     """Обработчик команды отмены записи"""
     try:
-        async with SessionLocal() as session:
-            # Явное начало транзакции
-            async with session.begin():
-                user = await session.execute(
-                    select(User)
-                    .where(User.telegram_id == str(message.from_user.id))
-                    .execution_options(no_cache=True)
-                )
-                user = user.scalars().first()
+        bookings = await upcoming_bookings.get(message.from_user.id)
 
-                if not user:
-                    await message.answer("❌ Ошибка: пользователь не найден")
-                    return
+        if bookings is None:
+            await message.answer("❌ Ошибка: пользователь не найден")
+            return
 
-                # Получаем только будущие подтвержденные записи
-                now = datetime.now()
-                bookings = await session.execute(
-                    select(Booking, Service)
-                    .join(Service)
-                    .where(
-                        Booking.user_id == user.id,
-                        Booking.date >= now,
-                        Booking.confirmed == True
-                    )
-                    .order_by(Booking.date)
-                )
-                
-                bookings = bookings.all()
+        # Отменить можно только подтвержденные записи
+        bookings = [booking for booking in bookings if booking.confirmed]
 
-                if not bookings:
-                    await message.answer("ℹ️ У вас нет активных записей для отмены")
-                    return
+        if not bookings:
+            await message.answer("ℹ️ У вас нет активных записей для отмены")
+            return
 
-                # Создаем клавиатуру
-                keyboard = ReplyKeyboardMarkup(
-                    keyboard=[
-                        [KeyboardButton(
-                            text=f"{booking.id}: {service.name} на {booking.date.strftime('%d.%m.%Y %H:%M')}"
-                        )]
-                        for booking, service in bookings
-                    ] + [[KeyboardButton(text="🔙 Назад")]],
-                    resize_keyboard=True,
-                    one_time_keyboard=True
-                )
+        # Создаем клавиатуру
+        keyboard = cached_reply_keyboard(
+            [
+                [f"{booking.id}: {booking.service_name} на {booking.date.strftime('%d.%m.%Y %H:%M')}"]
+                for booking in bookings
+            ] + [["🔙 Назад"]],
+            one_time_keyboard=True
+        )
 
-                await message.answer(
-                    "📋 Выберите запись для отмены:",
-                    reply_markup=keyboard
-                )
-                await state.set_state(CancelStates.waiting_for_booking)
+        await message.answer(
+            "📋 Выберите запись для отмены:",
+            reply_markup=keyboard
+        )
+        await state.set_state(CancelStates.waiting_for_booking)
 
     except Exception as e:
-        logger.error(f"Ошибка в cancel_handler: {str(e)}", exc_info=True)
+        logger.error("Ошибка в cancel_handler: %s", e, exc_info=True)
         await message.answer(
             "❌ Произошла ошибка при получении ваших записей. Пожалуйста, попробуйте позже.",
             reply_markup=get_client_keyboard()
@@ -725,12 +792,9 @@ async def process_cancel_confirmation(message: types.Message, state: FSMContext)
         return
     
     async with SessionLocal() as session:
-        user = await session.execute(
-            select(User).where(User.telegram_id == str(message.from_user.id))
-        )
-        user = user.scalars().first()
+        user_id = await get_user_id(session, message.from_user.id)
         
-        if user.cancels_this_month >= 1:
+        if not user_id or not await can_perform_action(session, user_id, ACTION_CANCEL):
             await message.answer(
                 "Вы уже использовали свой лимит отмен в этом месяце",
                 reply_markup=get_client_keyboard()
@@ -807,14 +871,7 @@ async def cancel_select_booking(message: types.Message, state: FSMContext):
                 booking_time = booking.date.strftime('%d.%m.%Y %H:%M')
                 
                 # Создаем клавиатуру подтверждения
-                keyboard = ReplyKeyboardMarkup(
-                    keyboard=[
-                        [KeyboardButton(text="✅ Да, отменить запись")],
-                        [KeyboardButton(text="❌ Нет, оставить запись")]
-                    ],
-                    resize_keyboard=True,
-                    one_time_keyboard=True
-                )
+                keyboard = get_cancel_confirm_keyboard()
                 
                 await message.answer(
                     f"❓ Вы уверены, что хотите отменить запись?\n\n"
@@ -830,10 +887,10 @@ async def cancel_select_booking(message: types.Message, state: FSMContext):
             "⚠️ Пожалуйста, выберите запись из предложенного списка",
             reply_markup=get_client_keyboard()
         )
-        logger.warning(f"Некорректный ввод при отмене записи: {str(e)}")
+        logger.warning("Некорректный ввод при отмене записи: %s", e)
         
     except Exception as e:
-        logger.error(f"Ошибка при отмене записи: {str(e)}", exc_info=True)
+        logger.error("Ошибка при отмене записи: %s", e, exc_info=True)
         await message.answer(
             "⚠️ Произошла ошибка при обработке вашего выбора. Пожалуйста, попробуйте еще раз или обратитесь в поддержку.",
             reply_markup=get_client_keyboard()
@@ -891,20 +948,11 @@ async def cancel_confirm(message: types.Message, state: FSMContext):
                     await state.clear()
                     return
 
-                # Получаем пользователя для обновления счетчика
-                user = await session.get(User, booking.user_id)
-                current_month = datetime.now().month
-                
-                # Сбрасываем счетчики если месяц сменился
-                if user.last_action_month != current_month:
-                    user.reschedules_this_month = 0
-                    user.cancels_this_month = 0
-                    user.last_action_month = current_month
-                
-                # Проверяем лимит отмен
-                if user.cancels_this_month >= 1:
+                # Проверяем и засчитываем лимит отмен одним атомарным запросом
+                if not await consume_quota(session, booking.user_id, ACTION_CANCEL):
+                    limit = MONTHLY_LIMITS[ACTION_CANCEL]
                     await message.answer(
-                        "⚠️ Лимит отмен в этом месяце исчерпан (1/1)",
+                        f"⚠️ Лимит отмен в этом месяце исчерпан ({limit}/{limit})",
                         reply_markup=get_client_keyboard()
                     )
                     await state.clear()
@@ -912,15 +960,19 @@ async def cancel_confirm(message: types.Message, state: FSMContext):
 
                 # Удаляем запись
                 await session.delete(booking)
-                user.cancels_this_month += 1
-                
-                await message.answer(
-                    "✅ Запись успешно отменена",
-                    reply_markup=get_client_keyboard()
-                )
+            
+            bookings_changed(message.from_user.id)
+            record_event(
+                EVENT_CANCELLED, booking.id, booking.user_id,
+                message.from_user.id, booking.date
+            )
+            await message.answer(
+                "✅ Запись успешно отменена",
+                reply_markup=get_client_keyboard()
+            )
                 
     except Exception as e:
-        logger.error(f"Ошибка в cancel_confirm: {str(e)}", exc_info=True)
+        logger.error("Ошибка в cancel_confirm: %s", e, exc_info=True)
         await message.answer(
             "❌ Произошла ошибка при отмене записи",
             reply_markup=get_client_keyboard()
@@ -958,17 +1010,13 @@ async def process_booking_confirmation(callback_query: types.CallbackQuery):
 
                 if action == 'confirm':
                     # Проверяем, что время ещё доступно
-                    schedule_available = await session.execute(
-                        select(exists().where(
-                            Schedule.id == booking.schedule_id,
-                            ~exists().where(
-                                Booking.schedule_id == booking.schedule_id,
-                                Booking.confirmed == True,
-                                Booking.id != booking.id
-                            )
-                        ))
+                    overlapping = await session.execute(
+                        overlapping_bookings_query(booking.date, booking.end_date, booking.id)
+                        .where(Booking.staff_id == booking.staff_id
+                               if booking.staff_id else Booking.staff_id.is_(None))
                     )
-                    if not schedule_available.scalar():
+                    schedule_slot = await session.get(Schedule, booking.schedule_id)
+                    if not schedule_slot or len(overlapping.all()) >= schedule_slot.capacity:
                         await callback_query.message.edit_text(
                             "⚠️ Это время стало недоступно. Пожалуйста, выберите другое."
                         )
@@ -998,8 +1046,15 @@ async def process_booking_confirmation(callback_query: types.CallbackQuery):
                 await callback_query.message.edit_text(response_text)
                 await callback_query.answer()
 
+            bookings_changed(callback_query.from_user.id)
+            if action != 'confirm':
+                record_event(
+                    EVENT_CANCELLED, booking.id, booking.user_id,
+                    callback_query.from_user.id, booking.date
+                )
+
     except Exception as e:
-        logger.error(f"Ошибка в process_booking_confirmation: {str(e)}", exc_info=True)
+        logger.error("Ошибка в process_booking_confirmation: %s", e, exc_info=True)
         try:
             await callback_query.answer("Произошла ошибка. Попробуйте позже.")
         except:
@@ -1034,7 +1089,7 @@ async def process_feedback_rating(message: types.Message, state: FSMContext):
         
         async with SessionLocal() as session:
             user = await session.execute(
-                select(User).where(User.telegram_id == str(message.from_user.id))
+                USER_BY_TELEGRAM_ID, {"telegram_id": str(message.from_user.id)}
             )
             user = user.scalars().first()
             
@@ -1054,72 +1109,7 @@ async def process_feedback_rating(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("Пожалуйста, введите число от 1 до 5")
     except Exception as e:
-        logger.error(f"Ошибка при сохранении отзыва: {e}")
+        logger.error("Ошибка при сохранении отзыва: %s", e)
         await message.answer("Произошла ошибка при сохранении отзыва")
     finally:
         await state.clear()
-
-async def send_booking_reminders(bot: Bot):
-    """Функция отправки напоминаний о записях"""
-    async with SessionLocal() as session:
-        async with session.begin():
-            try:
-                # Напоминание за 24 часа
-                reminder_24h_time = datetime.now() + timedelta(hours=24)
-                bookings_24h = await session.execute(
-                    select(Booking, User, Service)
-                    .join(User)
-                    .join(Service)
-                    .where(
-                        func.date_trunc('hour', Booking.date) == func.date_trunc('hour', reminder_24h_time),
-                        Booking.reminder_24h_sent == False,
-                        Booking.confirmed == True
-                    )
-                    .execution_options(populate_existing=True)
-                )
-                bookings_24h = bookings_24h.all()
-
-                # Напоминание за 3 часа
-                reminder_3h_time = datetime.now() + timedelta(hours=3)
-                bookings_3h = await session.execute(
-                    select(Booking, User, Service)
-                    .join(User)
-                    .join(Service)
-                    .where(
-                        func.date_trunc('hour', Booking.date) == func.date_trunc('hour', reminder_3h_time),
-                        Booking.reminder_3h_sent == False,
-                        Booking.confirmed == True
-                    )
-                )
-                bookings_3h = bookings_3h.all()
-
-                # Отправка напоминаний за 24 часа
-                for booking, user, service in bookings_24h:
-                    try:
-                        await bot.send_message(
-                            chat_id=user.telegram_id,
-                            text=f"⏰ Напоминание: у вас запись на {service.name} "
-                                 f"завтра в {booking.date.strftime('%H:%M')}"
-                        )
-                        booking.reminder_24h_sent = True
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки напоминания 24h пользователю {user.id}: {e}")
-
-                # Отправка напоминаний за 3 часа
-                for booking, user, service in bookings_3h:
-                    try:
-                        await bot.send_message(
-                            chat_id=user.telegram_id,
-                            text=f"⏰ Напоминание: у вас запись на {service.name} "
-                                 f"через 3 часа ({booking.date.strftime('%H:%M')})"
-                        )
-                        booking.reminder_3h_sent = True
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки напоминания 3h пользователю {user.id}: {e}")
-
-                # Коммит транзакции выполнится автоматически при успешном завершении блока
-                
-            except Exception as e:
-                logger.error(f"Ошибка в send_booking_reminders: {e}", exc_info=True)
-                # Откат транзакции выполнится автоматически из-за исключения
-                raise  # Планировщик сам обработает это исключение
\ No newline at end of file
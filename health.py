@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from aiohttp import web
+from sqlalchemy import text
+
+from config import HEALTH_HOST, HEALTH_PORT, HEALTH_MAX_UPDATE_AGE
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+DB_PING_TIMEOUT = 2
+
+
+class HealthServer:
+    """HTTP-сервер проверок для оркестратора и балансировщика.
+
+    /health - живость: процесс отвечает, цикл событий не заблокирован.
+    /ready - готовность принимать трафик: БД отвечает, пул соединений
+    не исчерпан, планировщик (если есть) и опрос Telegram работают.
+    """
+
+    def __init__(self, max_update_age: int = HEALTH_MAX_UPDATE_AGE):
+        self.max_update_age = max_update_age
+        self.scheduler = None
+        # None - процесс не опрашивает Telegram (воркер)
+        self.polling: Optional[bool] = None
+        self.last_update_at: Optional[float] = None
+        self.started_at = time.monotonic()
+        self._runner: Optional[web.AppRunner] = None
+
+    def touch(self):
+        """Отмечает обработанный апдейт"""
+        self.last_update_at = time.monotonic()
+
+    async def _ping_db(self) -> dict:
+        async def ping():
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+
+        started = time.monotonic()
+        try:
+            # Таймаут и на получение соединения: при исчерпанном пуле не ждём pool_timeout
+            await asyncio.wait_for(ping(), timeout=DB_PING_TIMEOUT)
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+        return {"ok": True, "latency_ms": round((time.monotonic() - started) * 1000, 1)}
+
+    def _pool_status(self) -> dict:
+        pool = engine.pool
+        if not hasattr(pool, "checkedout"):
+            return {"ok": True}
+        capacity = pool.size() + max(getattr(pool, "_max_overflow", 0), 0)
+        checked_out = pool.checkedout()
+        return {"ok": checked_out < capacity, "checked_out": checked_out, "capacity": capacity}
+
+    def _updates_status(self) -> dict:
+        if self.polling is None:
+            return {"ok": True}
+        last = self.last_update_at or self.started_at
+        age = round(time.monotonic() - last, 1)
+        ok = self.polling and (not self.max_update_age or age <= self.max_update_age)
+        return {"ok": ok, "polling": self.polling, "last_update_age": age}
+
+    async def live(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    async def ready(self, request: web.Request) -> web.Response:
+        checks = {
+            "database": await self._ping_db(),
+            "pool": self._pool_status(),
+            "updates": self._updates_status()
+        }
+        if self.scheduler is not None:
+            checks["scheduler"] = {"ok": bool(self.scheduler.running)}
+
+        ready = all(check["ok"] for check in checks.values())
+        return web.json_response(
+            {"status": "ok" if ready else "degraded", "checks": checks},
+            status=200 if ready else 503
+        )
+
+    async def start(self, host: str = HEALTH_HOST, port: int = HEALTH_PORT):
+        app = web.Application()
+        app.router.add_get("/health", self.live)
+        app.router.add_get("/ready", self.ready)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info("Проверки здоровья доступны на %s:%s", host, port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+health = HealthServer()
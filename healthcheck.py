@@ -0,0 +1,22 @@
+"""Проверка живости для HEALTHCHECK контейнера: python healthcheck.py.
+
+Обращается к /health процесса в этом же контейнере (см. health.py).
+Код выхода 0 - процесс отвечает, 1 - нет.
+"""
+import os
+import sys
+import urllib.request
+
+
+def check() -> bool:
+    port = os.getenv("HEALTH_PORT", "8000")
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=3) as response:
+            return response.status == 200
+    except Exception as e:
+        print(f"Health check failed: {e}", file=sys.stderr)
+        return False
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check() else 1)
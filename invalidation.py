@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set
+
+from sqlalchemy.engine import make_url
+
+from config import DATABASE_URL, INVALIDATION_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+# Темы уведомлений; ключ уточняет, что именно изменилось (None - всё)
+TOPIC_USER_BOOKINGS = "user_bookings"  # ключ - telegram id пользователя
+TOPIC_SERVICES = "services"
+TOPIC_SCHEDULE = "schedule"
+
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+
+
+class InvalidationBus:
+    """Шина сброса кэшей между репликами.
+
+    publish() сразу сбрасывает кэши своего процесса и отправляет NOTIFY,
+    остальные реплики получают его на отдельном соединении asyncpg (LISTEN)
+    и сбрасывают у себя ровно то, что изменилось. На других СУБД (SQLite в
+    разработке) процесс один, и шина работает только локально.
+
+    Уведомления, пришедшие, пока соединения не было, потеряны, поэтому после
+    (пере)подключения кэши сбрасываются целиком.
+    """
+
+    def __init__(self, channel: str = INVALIDATION_CHANNEL):
+        self.channel = channel
+        self._subscribers: Dict[str, List[Callable]] = defaultdict(list)
+        self._conn = None
+        self._lock = asyncio.Lock()
+        self._closed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Set[asyncio.Task] = set()
+
+    def subscribe(self, topic: str, callback: Callable[[Optional[object]], None]):
+        """callback(key) вызывается при изменении; key=None - сбросить всё"""
+        self._subscribers[topic].append(callback)
+
+    def _deliver(self, topic: str, key=None):
+        for callback in self._subscribers.get(topic, ()):
+            try:
+                callback(key)
+            except Exception as e:
+                logger.error("Ошибка сброса кэша %s: %s", topic, e)
+
+    def _deliver_all(self):
+        for topic in list(self._subscribers):
+            self._deliver(topic)
+
+    def publish(self, topic: str, key=None):
+        """Сообщает об изменении после коммита. Можно вызывать из синхронного
+        кода (хуки сессии): уведомление уходит в фоне"""
+        self._deliver(topic, key)
+        if self._conn is None:
+            return
+        task = asyncio.get_running_loop().create_task(
+            self._notify(json.dumps([topic, key], separators=(",", ":")))
+        )
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _notify(self, payload: str):
+        try:
+            # Соединение asyncpg не выполняет запросы параллельно
+            async with self._lock:
+                if self._conn is not None:
+                    await self._conn.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+        except Exception as e:
+            logger.warning("Не удалось отправить уведомление %s: %s", payload, e)
+
+    def _on_notification(self, conn, pid, channel, payload):
+        # Свои уведомления уже доставлены локально в publish()
+        if pid == conn.get_server_pid():
+            return
+        try:
+            topic, key = json.loads(payload)
+        except (ValueError, TypeError):
+            logger.warning("Некорректное уведомление: %s", payload)
+            return
+        self._deliver(topic, key)
+
+    def _on_termination(self, conn):
+        self._conn = None
+        self._closed.set()
+
+    async def _connect(self):
+        import asyncpg
+
+        dsn = make_url(DATABASE_URL).set(drivername="postgresql")
+        conn = await asyncpg.connect(dsn.render_as_string(hide_password=False))
+        await conn.add_listener(self.channel, self._on_notification)
+        conn.add_termination_listener(self._on_termination)
+        self._closed.clear()
+        self._conn = conn
+        self._deliver_all()
+        logger.info("Подписка на канал %s установлена", self.channel)
+
+    async def _run(self):
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                await self._connect()
+                delay = RECONNECT_DELAY
+                await self._closed.wait()
+                logger.warning("Соединение канала %s потеряно", self.channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка подключения к каналу %s: %s", self.channel, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def start(self):
+        """Слушает канал, если БД - Postgres через asyncpg"""
+        if self._task is None and make_url(DATABASE_URL).get_driver_name() == "asyncpg":
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await conn.close()
+
+
+invalidation_bus = InvalidationBus()
@@ -1,34 +1,127 @@
-from asyncio.log import logger
+import logging
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from typing import Dict, Optional, Sequence
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.methods import TelegramMethod
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from sqlalchemy import select, func, and_, exists
-from sqlalchemy.ext.asyncio import AsyncSession
+from aiohttp import FormData
+from sqlalchemy import select
 
-from database import SessionLocal
-from models import Service, Schedule, Booking, User
+from database import SessionLocal, ReadSessionLocal
+from models import Service, Schedule, DEFAULT_SERVICE_DURATION
+from slots import get_free_places
+from sqlfuncs import day_start, month_start
+from bookings_cache import upcoming_bookings
+from slot_holds import slot_holds
+from invalidation import invalidation_bus, TOPIC_SERVICES, TOPIC_SCHEDULE
+from config import SHARED_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+# Объекты aiogram неизменяемые, поэтому одну клавиатуру можно отдавать во все ответы.
+# Клавиатуры из кэша отправляются уже сериализованными (см. CachedMarkupSession):
+# id объекта -> JSON, None - ещё не сериализована
+_serialized_markups: Dict[int, Optional[str]] = {}
+
+KEYBOARD_CACHE_SIZE = 256
+_keyboard_cache: "OrderedDict[tuple, ReplyKeyboardMarkup]" = OrderedDict()
+
+def _build_reply_keyboard(rows: Sequence[Sequence[str]], **options) -> ReplyKeyboardMarkup:
+    markup = ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=text) for text in row] for row in rows],
+        **options
+    )
+    _serialized_markups[id(markup)] = None
+    return markup
+
+def cached_reply_keyboard(rows: Sequence[Sequence[str]], resize_keyboard: bool = True, **options) -> ReplyKeyboardMarkup:
+    """Клавиатура из кэша по содержимому: одинаковые кнопки - один и тот же объект"""
+    key = (tuple(map(tuple, rows)), resize_keyboard, tuple(sorted(options.items())))
+    markup = _keyboard_cache.get(key)
+    if markup is not None:
+        _keyboard_cache.move_to_end(key)
+        return markup
+
+    markup = _build_reply_keyboard(rows, resize_keyboard=resize_keyboard, **options)
+    _keyboard_cache[key] = markup
+    if len(_keyboard_cache) > KEYBOARD_CACHE_SIZE:
+        _, evicted = _keyboard_cache.popitem(last=False)
+        _serialized_markups.pop(id(evicted), None)
+    return markup
+
+class CachedMarkupSession(AiohttpSession):
+    """Сессия бота, подставляющая заранее сериализованный JSON клавиатур из кэша
+    вместо повторного model_dump и json.dumps на каждый ответ"""
+
+    def build_form_data(self, bot: Bot, method: TelegramMethod) -> FormData:
+        markup = getattr(method, "reply_markup", None)
+        if markup is None or id(markup) not in _serialized_markups:
+            return super().build_form_data(bot, method)
+
+        serialized = _serialized_markups[id(markup)]
+        if serialized is None:
+            # prepare_value в aiogram 3.2 не сериализует объекты Telegram сам,
+            # поэтому клавиатура сначала переводится в словарь
+            serialized = self.json_dumps(markup.model_dump(exclude_none=True, warnings=False))
+            _serialized_markups[id(markup)] = serialized
+
+        form = super().build_form_data(bot, method.model_copy(update={"reply_markup": None}))
+        form.add_field("reply_markup", serialized)
+        return form
+
+# Статические клавиатуры создаются один раз при импорте
+_ADMIN_KEYBOARD = _build_reply_keyboard([
+    ["👁️ Просмотр записей", "📅 Создать расписание"],
+    ["📝 Добавить услугу", "✏️ Редактировать услугу"],
+    ["🗑️ Удалить услугу", "📢 Рассылка"],
+    ["📋 Посмотреть расписание", "📝 Посмотреть отзывы"]  # Новая кнопка
+], resize_keyboard=True)
+
+_CLIENT_KEYBOARD = _build_reply_keyboard([
+    ["💈 Записаться на услугу", "📋 Мои записи"],
+    ["🔄 Перенести запись", "❌ Отменить запись"],
+    ["📝 Оставить отзыв"]  # Важно: текст должен совпадать с обработчиком
+], resize_keyboard=True)
+
+_CANCEL_KEYBOARD = _build_reply_keyboard([["❌ Отмена"]], resize_keyboard=True)
+
+_BACK_KEYBOARD = _build_reply_keyboard([["🔙 Назад"]], resize_keyboard=True)
+
+_CANCEL_CONFIRM_KEYBOARD = _build_reply_keyboard([
+    ["✅ Да, отменить запись"],
+    ["❌ Нет, оставить запись"]
+], resize_keyboard=True, one_time_keyboard=True)
+
+_TIME_CONFIRM_KEYBOARD = _build_reply_keyboard([
+    ["✅ Подтвердить"],
+    ["🔙 Назад"]
+], resize_keyboard=True)
+
+_DATES_ERROR_KEYBOARD = _build_reply_keyboard([
+    ["Ошибка загрузки дат"],
+    ["🔙 Назад"]
+], resize_keyboard=True)
 
 def get_admin_keyboard() -> ReplyKeyboardMarkup:
-    buttons = [
-        [KeyboardButton(text="👁️ Просмотр записей"), KeyboardButton(text="📅 Создать расписание")],
-        [KeyboardButton(text="📝 Добавить услугу"), KeyboardButton(text="✏️ Редактировать услугу")],
-        [KeyboardButton(text="🗑️ Удалить услугу"), KeyboardButton(text="📢 Рассылка")],
-        [KeyboardButton(text="📋 Посмотреть расписание"), KeyboardButton(text="📝 Посмотреть отзывы")]  # Новая кнопка
-    ]
-    return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+    return _ADMIN_KEYBOARD
 
 def get_client_keyboard() -> ReplyKeyboardMarkup:
-    buttons = [
-        [KeyboardButton(text="💈 Записаться на услугу"), KeyboardButton(text="📋 Мои записи")],
-        [KeyboardButton(text="🔄 Перенести запись"), KeyboardButton(text="❌ Отменить запись")],
-        [KeyboardButton(text="📝 Оставить отзыв")]  # Важно: текст должен совпадать с обработчиком
-    ]
-    return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+    return _CLIENT_KEYBOARD
 
 def get_cancel_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="❌ Отмена")]],
-        resize_keyboard=True
-    )
+    return _CANCEL_KEYBOARD
+
+def get_back_keyboard() -> ReplyKeyboardMarkup:
+    return _BACK_KEYBOARD
+
+def get_cancel_confirm_keyboard() -> ReplyKeyboardMarkup:
+    return _CANCEL_CONFIRM_KEYBOARD
+
+def get_time_confirm_keyboard() -> ReplyKeyboardMarkup:
+    return _TIME_CONFIRM_KEYBOARD
 
 def get_confirm_keyboard(booking_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -38,105 +131,82 @@ def get_confirm_keyboard(booking_id: int) -> InlineKeyboardMarkup:
         ]
     ])
 
-async def get_services_keyboard() -> ReplyKeyboardMarkup:
-    async with SessionLocal() as session:
-        services = await session.execute(select(Service))
-        buttons = [[KeyboardButton(text=f"{service.name} - {service.price}₽")] for service in services.scalars()]
-        buttons.append([KeyboardButton(text="🔙 Назад")])
-        return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+class SharedKeyboardCache:
+    """Клавиатура, одинаковая для всех пользователей (услуги, месяцы).
 
-async def get_days_keyboard_for_month(month: str) -> ReplyKeyboardMarkup:
+    Хранится до сообщения об изменении данных через invalidation_bus или не
+    дольше ttl секунд. Поколение не даёт сохранить клавиатуру, построенную
+    по данным, которые изменились, пока она строилась.
+    """
+
+    def __init__(self, build, ttl: float = SHARED_CACHE_TTL):
+        self._build = build
+        self.ttl = ttl
+        self._entries: Dict[object, tuple] = {}
+        self._generation = 0
+
+    async def get(self, key=None) -> ReplyKeyboardMarkup:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        generation = self._generation
+        markup = await self._build()
+        if generation == self._generation:
+            self._entries[key] = (time.monotonic() + self.ttl, markup)
+        return markup
+
+    def invalidate(self, key=None):
+        self._generation += 1
+        self._entries.clear()
+
+
+async def _build_services_keyboard() -> ReplyKeyboardMarkup:
     async with SessionLocal() as session:
-        try:
-            # Русские названия месяцев для обратного преобразования
-            month_map = {
-                'Январь': 1, 'Февраль': 2, 'Март': 3,
-                'Апрель': 4, 'Май': 5, 'Июнь': 6,
-                'Июль': 7, 'Август': 8, 'Сентябрь': 9,
-                'Октябрь': 10, 'Ноябрь': 11, 'Декабрь': 12
-            }
-            
-            # Разбираем строку месяца (формат "Апрель 2025")
-            month_parts = month.split()
-            if len(month_parts) != 2:
-                raise ValueError("Неверный формат месяца")
-                
-            month_name = month_parts[0]
-            year = int(month_parts[1])
-            month_num = month_map.get(month_name)
-            
-            if not month_num:
-                raise ValueError(f"Неизвестный месяц: {month_name}")
+        services = await session.execute(select(Service.name, Service.price))
+        rows = [[f"{name} - {price}₽"] for name, price in services]
+        rows.append(["🔙 Назад"])
+        return cached_reply_keyboard(rows)
 
-            # Границы месяца
-            start_date = datetime(year, month_num, 1)
-            if month_num == 12:
-                end_date = datetime(year + 1, 1, 1)
-            else:
-                end_date = datetime(year, month_num + 1, 1)
+_services_keyboard = SharedKeyboardCache(_build_services_keyboard)
+invalidation_bus.subscribe(TOPIC_SERVICES, _services_keyboard.invalidate)
 
-            # Получаем все дни месяца, где есть хотя бы один слот
-            days = await session.execute(
-                select(func.to_char(Schedule.date, 'DD.MM.YYYY').label("day"))
-                .where(
-                    Schedule.date >= start_date,
-                    Schedule.date < end_date,
-                    Schedule.date >= datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-                )
-                .distinct()
-                .order_by("day")
-            )
+async def get_services_keyboard() -> ReplyKeyboardMarkup:
+    return await _services_keyboard.get()
 
-            buttons = [[KeyboardButton(text=day)] for day in days.scalars()]
-            if not buttons:
-                buttons.append([KeyboardButton(text="Нет доступных дат")])
-            buttons.append([KeyboardButton(text="🔙 Назад")])
-            
-            return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
-            
-        except Exception as e:
-            logger.error(f"Error in get_days_keyboard_for_month: {str(e)}")
-            return ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text="Ошибка загрузки дат")],
-                    [KeyboardButton(text="🔙 Назад")]
-                ],
-                resize_keyboard=True
-            )
-        
-async def get_months_keyboard(admin_mode=False):
+MONTH_NAMES = (
+    'Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
+    'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь'
+)
+
+async def _build_months_keyboard() -> ReplyKeyboardMarkup:
+    # Клавиатура общая и хранится долго: читаем с основной БД, а не с
+    # отстающей реплики, чтобы не закэшировать месяцы без новых слотов
     async with SessionLocal() as session:
-        month_translation = {
-            'January': 'Январь', 'February': 'Февраль', 'March': 'Март',
-            'April': 'Апрель', 'May': 'Май', 'June': 'Июнь',
-            'July': 'Июль', 'August': 'Август', 'September': 'Сентябрь',
-            'October': 'Октябрь', 'November': 'Ноябрь', 'December': 'Декабрь'
-        }
-        
+        month = month_start(Schedule.date).label("month")
         months = await session.execute(
-            select(
-                func.to_char(Schedule.date, 'Month YYYY').label("month"),
-                func.to_char(Schedule.date, 'MM.YYYY').label("month_key")
-            )
+            select(month)
             .where(Schedule.date >= datetime.now())
-            .group_by("month", "month_key")
-            .order_by(func.min(Schedule.date))
+            .group_by(month)
+            .order_by(month)
         )
 
-        buttons = []
-        for month, month_key in months:
-            eng_month = month.split()[0]
-            ru_month = month_translation.get(eng_month, eng_month)
-            ru_month_str = f"{ru_month} {month.split()[1]}"
-            buttons.append([KeyboardButton(text=ru_month_str.strip())])
+        rows = []
+        for month_date in months.scalars():
+            rows.append([f"{MONTH_NAMES[month_date.month - 1]} {month_date.year}"])
         
         # Всегда добавляем кнопку "Назад"
-        buttons.append([KeyboardButton(text="🔙 Назад")])
+        rows.append(["🔙 Назад"])
         
-        return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+        return cached_reply_keyboard(rows)
+
+_months_keyboard = SharedKeyboardCache(_build_months_keyboard)
+invalidation_bus.subscribe(TOPIC_SCHEDULE, _months_keyboard.invalidate)
+
+async def get_months_keyboard(admin_mode=False):
+    return await _months_keyboard.get()
 
 async def get_days_keyboard_for_month(month: str, admin_mode=False):
-    async with SessionLocal() as session:
+    async with ReadSessionLocal() as session:
         try:
             month_map = {
                 'Январь': 1, 'Февраль': 2, 'Март': 3,
@@ -156,105 +226,90 @@ async def get_days_keyboard_for_month(month: str, admin_mode=False):
             else:
                 end_date = datetime(year, month_num + 1, 1)
 
+            day = day_start(Schedule.date).label("day")
             days = await session.execute(
-                select(func.to_char(Schedule.date, 'DD.MM.YYYY').label("day"))
+                select(day)
                 .where(
                     Schedule.date >= start_date,
                     Schedule.date < end_date,
                     Schedule.date >= datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
                 )
                 .distinct()
-                .order_by("day")
+                .order_by(day)
             )
 
-            buttons = [[KeyboardButton(text=day)] for day in days.scalars()]
+            rows = [[day_date.strftime('%d.%m.%Y')] for day_date in days.scalars()]
             
             # Всегда добавляем кнопку "Назад"
-            buttons.append([KeyboardButton(text="🔙 Назад")])
+            rows.append(["🔙 Назад"])
             
-            return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+            return cached_reply_keyboard(rows)
             
         except Exception as e:
-            logger.error(f"Error in get_days_keyboard_for_month: {str(e)}")
-            return ReplyKeyboardMarkup(
-                keyboard=[
-                    [KeyboardButton(text="Ошибка загрузки дат")],
-                    [KeyboardButton(text="🔙 Назад")]
-                ],
-                resize_keyboard=True
-            )
+            logger.error("Error in get_days_keyboard_for_month: %s", e)
+            return _DATES_ERROR_KEYBOARD
 
-async def get_times_keyboard(day: str, exclude_booking_id: int = None):
+async def get_offered_times(
+    day: str,
+    exclude_booking_id: int = None,
+    duration: int = DEFAULT_SERVICE_DURATION,
+    telegram_id: int = None
+) -> Optional[Dict[datetime, Optional[int]]]:
+    """Время начала, которое можно предложить пользователю telegram_id в день day,
+    и мастер, у которого это время за ним закрепить; None - день указан неверно"""
     try:
         day_date = datetime.strptime(day, '%d.%m.%Y').date()
     except ValueError:
-        return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="🔙 Назад")]], resize_keyboard=True)
+        return None
     
     async with SessionLocal() as session:
-        # Получаем только свободные слоты
-        query = select(Schedule).where(
-            func.date(Schedule.date) == day_date,
-            Schedule.date >= datetime.now(),
-            ~exists().where(
-                and_(
-                    Booking.schedule_id == Schedule.id,
-                    Booking.confirmed == True
-                )
-            )
+        # Получаем только слоты, куда услуга помещается целиком
+        day_start = datetime.combine(day_date, datetime.min.time())
+        start = max(day_start, datetime.now())
+        places = await get_free_places(
+            session, start, day_start + timedelta(days=1), duration, exclude_booking_id
         )
-        
-        if exclude_booking_id:
-            query = query.where(
-                ~exists().where(
-                    and_(
-                        Booking.schedule_id == Schedule.id,
-                        Booking.confirmed == True,
-                        Booking.id != exclude_booking_id
-                    )
-                )
-            )
-        
-        available_slots = await session.execute(query.order_by(Schedule.date))
-        
-        buttons = [
-            [KeyboardButton(text=slot.date.strftime('%H:%M'))]
-            for slot in available_slots.scalars()
-        ]
-        
-        if not buttons:
-            buttons.append([KeyboardButton(text="Нет свободных слотов")])
-        
-        buttons.append([KeyboardButton(text="🔙 Назад")])
-        return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+    
+    # Время, выбранное другими пользователями и ожидающее их подтверждения,
+    # занимает место у своего мастера. Несколько мастеров на одно время
+    # показываются одной кнопкой, пока хотя бы у одного остаётся место
+    length = timedelta(minutes=duration)
+    offered = {}
+    for slot, free in places:
+        if slot.date in offered:
+            continue
+        held = slot_holds.count_overlaps(slot.staff_id, slot.date, slot.date + length, telegram_id)
+        if held < free:
+            offered[slot.date] = slot.staff_id
+    # Порядок кнопок - по времени, как и строки слотов
+    return dict(sorted(offered.items()))
+
+async def get_times_keyboard(
+    day: str,
+    exclude_booking_id: int = None,
+    duration: int = DEFAULT_SERVICE_DURATION,
+    telegram_id: int = None
+):
+    times = await get_offered_times(day, exclude_booking_id, duration, telegram_id)
+    if times is None:
+        return _BACK_KEYBOARD
+    
+    rows = [[slot_time.strftime('%H:%M')] for slot_time in times]
+    
+    if not rows:
+        rows.append(["Нет свободных слотов"])
+    
+    rows.append(["🔙 Назад"])
+    return cached_reply_keyboard(rows)
     
 async def get_user_bookings_keyboard(user_id: int) -> ReplyKeyboardMarkup:
-    async with SessionLocal() as session:
-        user = await session.execute(
-            select(User).where(User.telegram_id == str(user_id))
-        )
-        user = user.scalars().first()
-        
-        if not user:
-            return None
-        
-        bookings = await session.execute(
-            select(Booking, Service)
-            .join(Service)
-            .where(
-                Booking.user_id == user.id,
-                Booking.date >= datetime.now()
-            )
-            .order_by(Booking.date)
-        )
-        
-        buttons = []
-        for booking, service in bookings:
-            buttons.append([KeyboardButton(
-                text=f"{booking.id}: {service.name} на {booking.date.strftime('%d.%m.%Y %H:%M 🕒')}"
-            )])
-        
-        if not buttons:
-            return None
-            
-        buttons.append([KeyboardButton(text="🔙 Назад")])
-        return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
\ No newline at end of file
+    bookings = await upcoming_bookings.get(user_id)
+    if not bookings:
+        return None
+    
+    rows = []
+    for booking in bookings:
+        rows.append([f"{booking.id}: {booking.service_name} на {booking.date.strftime('%d.%m.%Y %H:%M 🕒')}"])
+    
+    rows.append(["🔙 Назад"])
+    return cached_reply_keyboard(rows)
\ No newline at end of file
@@ -0,0 +1,52 @@
+import importlib
+import inspect
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def lazy_handler(module_name: str, name: str):
+    """Обработчик, модуль которого импортируется при первом вызове.
+
+    aiogram передаёт обработчику только те аргументы, что есть в его сигнатуре.
+    Обёртка принимает все (**kwargs) и после импорта отфильтровывает лишние
+    по сигнатуре настоящего обработчика.
+    """
+    resolved = {}
+
+    def resolve():
+        if not resolved:
+            handler = getattr(importlib.import_module(module_name), name)
+            params = inspect.signature(handler).parameters.values()
+            resolved["handler"] = handler
+            resolved["varkw"] = any(p.kind == p.VAR_KEYWORD for p in params)
+            resolved["params"] = {p.name for p in params if p.kind != p.VAR_KEYWORD}
+            logger.debug("Загружен обработчик %s.%s", module_name, name)
+        return resolved
+
+    async def handler(event, **kwargs):
+        target = resolve()
+        if not target["varkw"]:
+            kwargs = {key: value for key, value in kwargs.items() if key in target["params"]}
+        return await target["handler"](event, **kwargs)
+
+    handler.__name__ = handler.__qualname__ = name
+    handler.__module__ = module_name
+    return handler
+
+
+class LazyModule:
+    """Модуль обработчиков для регистрации без импорта:
+    dp.message.register(user.start_handler, ...) подключит handlers.user
+    только когда до start_handler дойдёт первый апдейт"""
+
+    def __init__(self, module_name: str):
+        self._module_name = module_name
+        self._handlers = {}
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name not in self._handlers:
+            self._handlers[name] = lazy_handler(self._module_name, name)
+        return self._handlers[name]
@@ -0,0 +1,137 @@
+import asyncio
+import functools
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Optional
+
+from sqlalchemy import update, or_
+from sqlalchemy.exc import IntegrityError
+
+from config import LEADER_LEASE_SECONDS
+from database import SessionLocal
+from models import SchedulerLease
+from sqlfuncs import db_now
+
+logger = logging.getLogger(__name__)
+
+# Уникальный идентификатор этого процесса среди реплик
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+async def acquire_lease(name: str, ttl: int) -> bool:
+    """Берёт или продлевает аренду. Одним условным UPDATE: аренда переходит
+    к нам, только если она наша или уже истекла.
+
+    Срок считается по часам БД: при расхождении часов реплик обе иначе
+    могли бы считать аренду истекшей и выполнять задачи одновременно.
+    """
+    expires_at = db_now(ttl)
+    async with SessionLocal() as session:
+        result = await session.execute(
+            update(SchedulerLease)
+            .where(
+                SchedulerLease.name == name,
+                or_(SchedulerLease.holder == INSTANCE_ID, SchedulerLease.expires_at < db_now(0))
+            )
+            .values(holder=INSTANCE_ID, expires_at=expires_at)
+        )
+        if result.rowcount:
+            await session.commit()
+            return True
+
+        # Строки аренды ещё нет - первая реплика её создаёт, остальные получат конфликт
+        session.add(SchedulerLease(name=name, holder=INSTANCE_ID, expires_at=expires_at))
+        try:
+            await session.commit()
+            return True
+        except IntegrityError:
+            await session.rollback()
+            return False
+
+
+async def release_lease(name: str):
+    """Отдаёт аренду досрочно, чтобы другая реплика подхватила задачи сразу"""
+    async with SessionLocal() as session:
+        await session.execute(
+            update(SchedulerLease)
+            .where(SchedulerLease.name == name, SchedulerLease.holder == INSTANCE_ID)
+            .values(expires_at=db_now(0))
+        )
+        await session.commit()
+
+
+class LeaderElection:
+    """Выбор ведущей реплики для фоновых задач.
+
+    Фоновая задача продлевает аренду каждые ttl/3 секунд. Задачи планировщика,
+    обёрнутые в leader_only, выполняются только на ведущей реплике; если она
+    упала, аренда истекает через ttl секунд и её забирает другая.
+    """
+
+    def __init__(self, name: str = "scheduler", ttl: int = LEADER_LEASE_SECONDS):
+        self.name = name
+        self.ttl = ttl
+        self._valid_until = 0.0  # по monotonic-часам этого процесса
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._valid_until
+
+    async def _renew(self):
+        started = time.monotonic()
+        try:
+            acquired = await acquire_lease(self.name, self.ttl)
+        except Exception as e:
+            logger.error("Ошибка продления аренды %s: %s", self.name, e)
+            acquired = False
+
+        was_leader = self.is_leader
+        # Срок считаем от начала запроса, чтобы не пережить аренду в БД
+        self._valid_until = started + self.ttl if acquired else 0.0
+        if acquired != was_leader:
+            logger.info("Реплика %s %s ведущей", INSTANCE_ID, 'стала' if acquired else 'больше не')
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            await self._renew()
+
+    async def start(self):
+        """Первая попытка выполняется сразу, чтобы задачи с запуском при старте
+        не пропустили свой такт"""
+        if self._task is None:
+            await self._renew()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            self._valid_until = 0.0
+            try:
+                await release_lease(self.name)
+            except Exception as e:
+                logger.error("Не удалось освободить аренду %s: %s", self.name, e)
+
+    def leader_only(self, job):
+        """Оборачивает задачу планировщика: на остальных репликах такт пропускается"""
+        @functools.wraps(job)
+        async def wrapper(*args, **kwargs):
+            if not self.is_leader:
+                logger.debug("Задача %s выполняется другой репликой", job.__name__)
+                return None
+            return await job(*args, **kwargs)
+
+        return wrapper
+
+
+leader = LeaderElection()
@@ -0,0 +1,95 @@
+import atexit
+import contextvars
+import json
+import logging
+import queue
+import sys
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+from config import LOG_FORMAT, LOG_LEVEL
+
+# Апдейт, который сейчас обрабатывается: update_id, user_id, handler, sampled.
+# Заполняется UpdateLogMiddleware, None - вне обработки апдейта (фоновые задачи)
+log_context: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("log_context", default=None)
+
+CONTEXT_FIELDS = ("update_id", "user_id", "handler")
+JSON_FIELDS = CONTEXT_FIELDS + ("latency_ms",)
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет к записи поля текущего апдейта и отбрасывает записи ниже
+    WARNING у апдейтов, не попавших в выборку"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = log_context.get()
+        if context is None:
+            return True
+        if not context.get("sampled", True) and record.levelno < logging.WARNING:
+            return False
+        for field in CONTEXT_FIELDS:
+            if getattr(record, field, None) is None:
+                setattr(record, field, context.get(field))
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Аргументы подставляются здесь, в потоке цикла событий: к моменту
+        # записи в другом потоке объекты из args могли измениться
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись журнала"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in JSON_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level: str = LOG_LEVEL, log_format: str = LOG_FORMAT) -> QueueListener:
+    """Настраивает корневой логгер: записи кладутся в очередь, а форматирует
+    и пишет их в stderr отдельный поток, так что цикл событий не ждёт вывода"""
+    stream = logging.StreamHandler(sys.stderr)
+    if log_format == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    # Итог обработки апдейта пишет UpdateLogMiddleware, с контекстом и временем
+    logging.getLogger("aiogram.event").setLevel(max(root.level, logging.WARNING))
+
+    listener = QueueListener(records, stream, respect_handler_level=True)
+    listener.start()
+    # Остаток очереди дописывается при выходе из процесса
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,219 @@
+import logging
+import random
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from config import LOG_SAMPLE_RATE
+from database import current_user_id
+from log_setup import log_context
+
+logger = logging.getLogger(__name__)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничение частоты запросов от одного пользователя.
+
+    У каждого пользователя своё "ведро токенов": burst запросов подряд,
+    дальше не чаще rate запросов в секунду. Повторное нажатие той же кнопки
+    в том же состоянии диалога в течение duplicate_window секунд отбрасывается
+    сразу; та же кнопка на следующем экране (например, "Назад" два раза
+    подряд) - обычный ввод и проходит. Лишние апдейты
+    не доходят до обработчиков и не занимают соединения из пула БД.
+    """
+
+    # Как часто чистить состояние давно неактивных пользователей
+    CLEANUP_EVERY = 10000
+    IDLE_TTL = 300
+
+    def __init__(self, rate: float = 1.0, burst: int = 5, duplicate_window: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self._buckets: Dict[int, list] = {}  # user_id -> [токены, время последнего пополнения]
+        self._last_press: Dict[int, tuple] = {}  # user_id -> (текст/данные, состояние FSM, время)
+        self._warned = set()  # кому уже сообщили о превышении лимита
+        self._calls = 0
+        self.stats = Counter()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        self._calls += 1
+        if self._calls % self.CLEANUP_EVERY == 0:
+            self._cleanup(now)
+
+        payload = event.data if isinstance(event, CallbackQuery) else getattr(event, "text", None)
+        fsm = data.get("state")
+        fsm_state = await fsm.get_state() if fsm is not None else None
+        last = self._last_press.get(user.id)
+        self._last_press[user.id] = (payload, fsm_state, now)
+        if (
+            last and payload is not None
+            and last[:2] == (payload, fsm_state)
+            and now - last[2] < self.duplicate_window
+        ):
+            self.stats["duplicates"] += 1
+            await self._reject(event)
+            return None
+
+        if not self._take_token(user.id, now):
+            self.stats["throttled"] += 1
+            if user.id not in self._warned:
+                self._warned.add(user.id)
+                await self._reject(event, "⏳ Слишком много запросов, подождите несколько секунд")
+            return None
+
+        self._warned.discard(user.id)
+        self.stats["passed"] += 1
+        return await handler(event, data)
+
+    def _take_token(self, user_id: int, now: float) -> bool:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            self._buckets[user_id] = [self.burst - 1, now]
+            return True
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    async def _reject(self, event: TelegramObject, text: str = None):
+        try:
+            if isinstance(event, CallbackQuery):
+                # Убираем "часики" на кнопке даже для отброшенного нажатия
+                await event.answer(text)
+            elif text and isinstance(event, Message):
+                await event.answer(text)
+        except Exception as e:
+            logger.warning("Не удалось ответить на ограниченный запрос: %s", e)
+
+    def _cleanup(self, now: float):
+        idle = [
+            user_id for user_id, (*_, last_seen) in self._last_press.items()
+            if now - last_seen > self.IDLE_TTL
+        ]
+        for user_id in idle:
+            self._last_press.pop(user_id, None)
+            self._buckets.pop(user_id, None)
+            self._warned.discard(user_id)
+        logger.info("Ограничение запросов: %s", dict(self.stats))
+
+
+class ActivityMiddleware(BaseMiddleware):
+    """Вызывает on_update после каждого обработанного апдейта (для проверок здоровья)"""
+
+    def __init__(self, on_update: Callable[[], None]):
+        self.on_update = on_update
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            self.on_update()
+
+
+class InFlightMiddleware(BaseMiddleware):
+    """Учитывает апдейт в счётчике выполняющихся, пока его обрабатывают"""
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        async with self.tracker.track():
+            return await handler(event, data)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Запоминает пользователя апдейта в current_user_id: по нему сессии
+    чтения решают, можно ли идти на реплику"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        token = current_user_id.set(user.id if user else None)
+        try:
+            return await handler(event, data)
+        finally:
+            current_user_id.reset(token)
+
+
+class UpdateLogMiddleware(BaseMiddleware):
+    """Контекст журнала для апдейта и итоговая запись с временем обработки.
+
+    Выборка решается один раз на апдейт: либо в журнал попадают все его
+    записи, либо (ниже WARNING) ни одной.
+    """
+
+    def __init__(self, sample_rate: float = LOG_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        context = {
+            "update_id": getattr(event, "update_id", None),
+            "user_id": user.id if user else None,
+            "handler": None,
+            "sampled": self.sample_rate >= 1 or random.random() < self.sample_rate,
+        }
+        token = log_context.set(context)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "Апдейт обработан",
+                    extra={"latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+                )
+            log_context.reset(token)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Записывает в контекст журнала имя обработчика, выбранного для апдейта"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        context = log_context.get()
+        handler_object = data.get("handler")
+        if context is not None and handler_object is not None:
+            context["handler"] = getattr(handler_object.callback, "__name__", None)
+        return await handler(event, data)
@@ -1,8 +1,10 @@
-from sqlalchemy import Boolean, Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Boolean, Column, Integer, String, DateTime, ForeignKey, UniqueConstraint, CheckConstraint, Index, DDL, JSON, event, text
 from sqlalchemy.orm import relationship
 from database import Base
 from datetime import datetime
 
+DEFAULT_SERVICE_DURATION = 60  # минут
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True)
@@ -10,9 +12,6 @@ class User(Base):
     first_name = Column(String, nullable=False)
     last_name = Column(String, nullable=False)
     phone = Column(String, nullable=False)
-    reschedules_this_month = Column(Integer, default=0)
-    cancels_this_month = Column(Integer, default=0)
-    last_action_month = Column(Integer)
     bookings = relationship("Booking", back_populates="user", cascade="all, delete-orphan")
     feedbacks = relationship("Feedback", back_populates="user")
 
@@ -22,26 +21,67 @@ class Service(Base):
     name = Column(String, nullable=False)
     price = Column(String, nullable=False)
     description = Column(String)
+    duration = Column(Integer, nullable=False, default=DEFAULT_SERVICE_DURATION)  # Длительность в минутах
+
+class Staff(Base):
+    __tablename__ = "staff"
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+    schedules = relationship("Schedule", back_populates="staff")
 
 class Schedule(Base):
     __tablename__ = "schedules"
+    # Один и тот же момент времени может быть у нескольких мастеров
+    __table_args__ = (
+        UniqueConstraint("date", "staff_id", name="uq_schedules_date_staff"),
+        # Несколько мест бывает только у общего слота: записи одного мастера
+        # не пересекаются (ex_bookings_staff_overlap)
+        CheckConstraint("staff_id IS NULL OR capacity = 1", name="ck_schedules_staff_capacity"),
+    )
     id = Column(Integer, primary_key=True)
-    date = Column(DateTime, nullable=False, unique=True, index=True)
+    date = Column(DateTime, nullable=False, index=True)
+    staff_id = Column(Integer, ForeignKey("staff.id"), nullable=True)  # NULL - общий слот без мастера
+    capacity = Column(Integer, nullable=False, default=1)  # Количество параллельных мест (кресел)
+    staff = relationship("Staff", back_populates="schedules")
     bookings = relationship("Booking", back_populates="schedule", cascade="all, delete-orphan")
 
 class Booking(Base):
     __tablename__ = "bookings"
+    __table_args__ = (Index("ix_bookings_staff_date", "staff_id", "date"),)
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False) 
-    date = Column(DateTime, nullable=False)
+    date = Column(DateTime, nullable=False, index=True)
+    end_date = Column(DateTime, nullable=False)  # date + длительность услуги
+    staff_id = Column(Integer, ForeignKey("staff.id"), nullable=True)  # Копия Schedule.staff_id для ограничения
     user = relationship("User", back_populates="bookings")
     service_id = Column(Integer, ForeignKey("services.id"), nullable=False)
     confirmed = Column(Boolean, default=True)
-    schedule_id = Column(Integer, ForeignKey("schedules.id"), nullable=False)  # Обязательная связь
+    schedule_id = Column(Integer, ForeignKey("schedules.id"), nullable=False, index=True)  # Обязательная связь
     schedule = relationship("Schedule", back_populates="bookings") 
     service = relationship("Service")
-    reminder_24h_sent = Column(Boolean, default=False)
-    reminder_3h_sent = Column(Boolean, default=False)
+    reminders = relationship("BookingReminder", cascade="all, delete-orphan", passive_deletes=True)
+    # Версия строки: каждое изменение записи её увеличивает, и изменение,
+    # сделанное по устаревшим данным, не проходит (оптимистичная блокировка)
+    version = Column(Integer, nullable=False, default=1)
+
+    __mapper_args__ = {"version_id_col": version}
+
+class BookingReminder(Base):
+    """Напоминание о записи; время отправки вычисляется при создании записи"""
+    __tablename__ = "booking_reminders"
+    __table_args__ = (
+        # Частичный индекс: запрос "что пора отправить" читает только неотправленные
+        Index(
+            "ix_booking_reminders_due", "due_at",
+            postgresql_where=text("sent_at IS NULL"),
+            sqlite_where=text("sent_at IS NULL")
+        ),
+    )
+    id = Column(Integer, primary_key=True)
+    booking_id = Column(Integer, ForeignKey("bookings.id", ondelete="CASCADE"), nullable=False, index=True)
+    offset_minutes = Column(Integer, nullable=False)
+    due_at = Column(DateTime, nullable=False)
+    sent_at = Column(DateTime)
 
 class Feedback(Base):
     __tablename__ = "feedbacks"
@@ -50,4 +90,96 @@ class Feedback(Base):
     text = Column(String(500), nullable=False)
     rating = Column(Integer)
     created_at = Column(DateTime, default=datetime.now)
-    user = relationship("User", back_populates="feedbacks")
\ No newline at end of file
+    user = relationship("User", back_populates="feedbacks")
+
+# Архив прошедших слотов и записей. В Postgres таблицы секционированы
+# по месяцам (RANGE по date), секции создаёт ночная задача archive.py
+class ScheduleArchive(Base):
+    __tablename__ = "schedules_archive"
+    __table_args__ = {"postgresql_partition_by": "RANGE (date)"}
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(DateTime, primary_key=True)
+    staff_id = Column(Integer)
+    capacity = Column(Integer, nullable=False)
+    archived_at = Column(DateTime, nullable=False)
+
+class BookingArchive(Base):
+    __tablename__ = "bookings_archive"
+    __table_args__ = (
+        Index("ix_bookings_archive_user_date", "user_id", "date"),
+        {"postgresql_partition_by": "RANGE (date)"},
+    )
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(DateTime, primary_key=True)
+    end_date = Column(DateTime)
+    user_id = Column(Integer, nullable=False)
+    service_id = Column(Integer, nullable=False)
+    schedule_id = Column(Integer, nullable=False)
+    staff_id = Column(Integer)
+    confirmed = Column(Boolean)
+    archived_at = Column(DateTime, nullable=False)
+
+class BookingEvent(Base):
+    """Журнал событий по записям; строки только добавляются"""
+    __tablename__ = "booking_events"
+    id = Column(Integer, primary_key=True)
+    booking_id = Column(Integer, nullable=False, index=True)  # Без FK: записи удаляются, история остаётся
+    user_id = Column(Integer, index=True)
+    actor_id = Column(String, nullable=False)  # telegram_id инициатора или "system"
+    event_type = Column(String(20), nullable=False)
+    booking_date = Column(DateTime)
+    details = Column(JSON)
+    created_at = Column(DateTime, nullable=False, default=datetime.now, index=True)
+
+class BroadcastJob(Base):
+    """Задание на рассылку; выполняется отдельным процессом worker.py"""
+    __tablename__ = "broadcast_jobs"
+    __table_args__ = (Index("ix_broadcast_jobs_status", "status", "id"),)
+    id = Column(Integer, primary_key=True)
+    text = Column(String, nullable=False)
+    parse_mode = Column(String(10))
+    requested_by = Column(String, nullable=False)  # telegram_id администратора для отчёта
+    status = Column(String(10), nullable=False, default="pending")  # pending, running, done, failed
+    total = Column(Integer, default=0)
+    success = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    # users.id последнего обработанного получателя: прерванная рассылка
+    # продолжается с него и не отправляет сообщения повторно
+    cursor_user_id = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    started_at = Column(DateTime)
+    # Отметка выполняющего воркера (по часам БД); задание без отметки дольше
+    # BROADCAST_LEASE_SECONDS считается брошенным и забирается заново
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+class SchedulerLease(Base):
+    """Аренда фоновой задачи: при нескольких репликах задачу выполняет держатель аренды"""
+    __tablename__ = "scheduler_leases"
+    name = Column(String(100), primary_key=True)
+    holder = Column(String(200), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+class ActionUsage(Base):
+    """Сколько раз пользователь выполнил ограниченное действие за период (месяц)"""
+    __tablename__ = "action_usage"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    action = Column(String(20), primary_key=True)
+    period = Column(String(7), primary_key=True)  # 'YYYY-MM'
+    count = Column(Integer, nullable=False, default=0)
+
+# Postgres не даст двум подтверждённым записям одного мастера пересечься по времени
+event.listen(
+    Base.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS btree_gist").execute_if(dialect="postgresql")
+)
+event.listen(
+    Booking.__table__,
+    "after_create",
+    DDL(
+        "ALTER TABLE bookings ADD CONSTRAINT ex_bookings_staff_overlap "
+        "EXCLUDE USING gist (staff_id WITH =, tsrange(date, end_date) WITH &&) "
+        "WHERE (confirmed AND staff_id IS NOT NULL)"
+    ).execute_if(dialect="postgresql")
+)
@@ -0,0 +1,65 @@
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import RESCHEDULE_MONTHLY_LIMIT, CANCEL_MONTHLY_LIMIT
+from models import ActionUsage
+
+ACTION_RESCHEDULE = "reschedule"
+ACTION_CANCEL = "cancel"
+
+MONTHLY_LIMITS = {
+    ACTION_RESCHEDULE: RESCHEDULE_MONTHLY_LIMIT,
+    ACTION_CANCEL: CANCEL_MONTHLY_LIMIT,
+}
+
+
+def current_period(now: Optional[datetime] = None) -> str:
+    """Период счётчика - год и месяц, чтобы январь не путался с январём прошлого года"""
+    return (now or datetime.now()).strftime('%Y-%m')
+
+
+async def get_usage(session: AsyncSession, user_id: int, action: str) -> int:
+    usage = await session.execute(
+        select(ActionUsage.count).where(
+            ActionUsage.user_id == user_id,
+            ActionUsage.action == action,
+            ActionUsage.period == current_period()
+        )
+    )
+    return usage.scalar() or 0
+
+
+async def can_perform_action(session: AsyncSession, user_id: int, action: str) -> bool:
+    """Предварительная проверка для интерфейса; окончательно лимит
+    проверяет consume_quota в транзакции самого действия"""
+    return await get_usage(session, user_id, action) < MONTHLY_LIMITS[action]
+
+
+async def consume_quota(session: AsyncSession, user_id: int, action: str) -> bool:
+    """Атомарно проверяет лимит и засчитывает действие одним запросом:
+    INSERT ... ON CONFLICT DO UPDATE ... WHERE count < limit RETURNING.
+
+    Возвращает False, если лимит исчерпан. Выполняется в транзакции действия:
+    при откате (например, время уже занято) попытка не засчитывается.
+    """
+    limit = MONTHLY_LIMITS[action]
+    if limit <= 0:
+        return False
+
+    insert = pg_insert if session.bind.dialect.name == "postgresql" else sqlite_insert
+    stmt = insert(ActionUsage).values(
+        user_id=user_id, action=action, period=current_period(), count=1
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ActionUsage.user_id, ActionUsage.action, ActionUsage.period],
+        set_={"count": ActionUsage.count + 1},
+        where=ActionUsage.count < limit
+    ).returning(ActionUsage.count)
+
+    result = await session.execute(stmt)
+    return result.scalar() is not None
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from audit import record_event, EVENT_REMINDED, SYSTEM_ACTOR
+from config import REMINDER_OFFSETS
+from database import SessionLocal
+from shutdown import in_flight
+from models import Booking, BookingReminder, User, Service
+
+logger = logging.getLogger(__name__)
+
+# Сколько напоминаний отправляется параллельно (лимит Telegram ~30 сообщений в секунду)
+REMINDER_BATCH_SIZE = 25
+
+REMINDER_TEMPLATE = "⏰ Напоминание: у вас запись на {service} {when}"
+
+
+def plural_ru(number: int, forms) -> str:
+    """Склонение: plural_ru(3, ('час', 'часа', 'часов')) -> 'часа'"""
+    if number % 10 == 1 and number % 100 != 11:
+        return forms[0]
+    if 2 <= number % 10 <= 4 and not 12 <= number % 100 <= 14:
+        return forms[1]
+    return forms[2]
+
+
+def describe_offset(offset_minutes: int, booking_date: datetime) -> str:
+    """Человекочитаемое время до записи для текста напоминания"""
+    time_str = booking_date.strftime('%H:%M')
+    if offset_minutes == 1440:
+        return f"завтра в {time_str}"
+    if offset_minutes % 1440 == 0:
+        days = offset_minutes // 1440
+        return f"через {days} {plural_ru(days, ('день', 'дня', 'дней'))} ({booking_date.strftime('%d.%m')} в {time_str})"
+    if offset_minutes % 60 == 0:
+        hours = offset_minutes // 60
+        return f"через {hours} {plural_ru(hours, ('час', 'часа', 'часов'))} ({time_str})"
+    return f"через {offset_minutes} {plural_ru(offset_minutes, ('минуту', 'минуты', 'минут'))} ({time_str})"
+
+
+def render_reminder(row) -> str:
+    return REMINDER_TEMPLATE.format(
+        service=row.service_name,
+        when=describe_offset(row.offset_minutes, row.date)
+    )
+
+
+def schedule_reminders(session: AsyncSession, booking_id: int, booking_date: datetime):
+    """Добавляет в сессию напоминания для записи по всем настроенным смещениям"""
+    now = datetime.now()
+    for offset in REMINDER_OFFSETS:
+        due_at = booking_date - timedelta(minutes=offset)
+        # Напоминание, срок которого уже прошёл к моменту записи, не нужно
+        if due_at > now:
+            session.add(BookingReminder(
+                booking_id=booking_id,
+                offset_minutes=offset,
+                due_at=due_at
+            ))
+
+
+async def mark_reminders_sent(reminder_ids, sent_at: datetime):
+    """Одним UPDATE отмечает напоминания отправленными"""
+    async with SessionLocal() as session:
+        await session.execute(
+            update(BookingReminder)
+            .where(BookingReminder.id.in_(reminder_ids))
+            .values(sent_at=sent_at)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+
+
+async def send_reminder_batch(bot: Bot, rows) -> int:
+    """Параллельно отправляет пачку напоминаний и одним UPDATE отмечает доставленные"""
+    results = await asyncio.gather(
+        *(
+            bot.send_message(chat_id=row.telegram_id, text=render_reminder(row))
+            for row in rows
+        ),
+        return_exceptions=True
+    )
+
+    sent = []
+    for row, result in zip(rows, results):
+        if isinstance(result, Exception):
+            logger.error("Ошибка отправки напоминания пользователю %s: %s", row.user_id, result)
+        else:
+            sent.append(row)
+
+    if sent:
+        # Флаги пишутся сразу после пачки: сбой на следующей пачке
+        # не приведёт к повторной отправке этой
+        await mark_reminders_sent([row.id for row in sent], datetime.now())
+        for row in sent:
+            record_event(
+                EVENT_REMINDED, row.booking_id, row.user_id, SYSTEM_ACTOR,
+                row.date, offset_minutes=row.offset_minutes
+            )
+    return len(sent)
+
+
+async def send_booking_reminders(bot: Bot):
+    """Функция отправки напоминаний о записях: один индексированный запрос
+    "что пора отправить" для напоминаний всех типов"""
+    now = datetime.now()
+    try:
+        async with SessionLocal() as session:
+            rows = await session.execute(
+                select(
+                    BookingReminder.id,
+                    BookingReminder.offset_minutes,
+                    Booking.id.label("booking_id"),
+                    Booking.user_id,
+                    Booking.date,
+                    User.telegram_id,
+                    Service.name.label("service_name")
+                )
+                .join(Booking, BookingReminder.booking_id == Booking.id)
+                .join(User, Booking.user_id == User.id)
+                .join(Service, Booking.service_id == Service.id)
+                .where(
+                    BookingReminder.sent_at.is_(None),
+                    BookingReminder.due_at <= now,
+                    Booking.date > now,
+                    Booking.confirmed == True
+                )
+                .order_by(BookingReminder.due_at)
+            )
+            rows = rows.all()
+
+        # Если бот простаивал и для записи созрело несколько напоминаний,
+        # отправляем только ближайшее к записи, остальные просто закрываем
+        latest = {}
+        for row in rows:
+            current = latest.get(row.booking_id)
+            if current is None or row.offset_minutes < current.offset_minutes:
+                latest[row.booking_id] = row
+        to_send = list(latest.values())
+        superseded = [row.id for row in rows if latest[row.booking_id] is not row]
+        if superseded:
+            await mark_reminders_sent(superseded, now)
+
+        for start in range(0, len(to_send), REMINDER_BATCH_SIZE):
+            if start:
+                if in_flight.stopping:
+                    # Процесс останавливается: отправленные пачки уже отмечены,
+                    # остальное отправит следующий запуск
+                    logger.info("Остановка: отложено %s напоминаний", len(to_send) - start)
+                    break
+                await asyncio.sleep(1)
+            await send_reminder_batch(bot, to_send[start:start + REMINDER_BATCH_SIZE])
+
+    except Exception as e:
+        logger.error("Ошибка в send_booking_reminders: %s", e, exc_info=True)
+        raise  # Планировщик сам обработает это исключение
@@ -0,0 +1,88 @@
+from typing import Iterable, List, Optional
+
+from aiogram import types
+
+# Ограничение Telegram на длину сообщения (в UTF-16 символах)
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def text_length(text: str) -> int:
+    """Длина так, как её считает Telegram: эмодзи занимают два символа"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _split_block(block: str, limit: int) -> List[str]:
+    # Блок длиннее сообщения режем по строкам, а строку - по символам
+    pieces, current, size = [], [], 0
+    for line in block.splitlines(keepends=True):
+        while text_length(line) > limit:
+            cut = limit
+            while text_length(line[:cut]) > limit:
+                cut -= 1
+            pieces.append(line[:cut])
+            line = line[cut:]
+        if current and size + text_length(line) > limit:
+            pieces.append("".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += text_length(line)
+    if current:
+        pieces.append("".join(current))
+    return pieces
+
+
+def chunk_blocks(
+    blocks: Iterable[str],
+    header: str = "",
+    footer: str = "",
+    limit: int = TELEGRAM_MESSAGE_LIMIT
+) -> List[str]:
+    """Собирает блоки (например, по одной записи) в сообщения не длиннее limit.
+
+    Блок не разрывается между сообщениями, если сам помещается в одно.
+    Текст собирается через join, поэтому время линейно от размера списка.
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+
+    def add(block: str):
+        nonlocal current, size
+        length = text_length(block)
+        if current and size + length > limit:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(block)
+        size += length
+
+    if header:
+        add(header)
+    for block in blocks:
+        if text_length(block) > limit:
+            for piece in _split_block(block, limit):
+                add(piece)
+        else:
+            add(block)
+    if footer:
+        add(footer)
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+async def answer_chunked(
+    message: types.Message,
+    blocks: Iterable[str],
+    header: str = "",
+    footer: str = "",
+    reply_markup=None,
+    parse_mode: Optional[str] = None
+):
+    """Отправляет длинный список несколькими сообщениями; клавиатура - у последнего"""
+    chunks = chunk_blocks(blocks, header, footer)
+    for number, chunk in enumerate(chunks, 1):
+        await message.answer(
+            chunk,
+            parse_mode=parse_mode,
+            reply_markup=reply_markup if number == len(chunks) else None
+        )
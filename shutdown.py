@@ -0,0 +1,77 @@
+import asyncio
+import contextlib
+import functools
+import logging
+
+from config import SHUTDOWN_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class InFlightTracker:
+    """Счётчик выполняющихся обработчиков и фоновых задач.
+
+    При остановке процесса новые апдейты уже не принимаются, а уже начатая
+    работа (транзакция, пачка напоминаний) должна завершиться, а не
+    оборваться на середине.
+    """
+
+    def __init__(self):
+        self._count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.stopping = False
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @contextlib.asynccontextmanager
+    async def track(self):
+        self._count += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._count -= 1
+            if not self._count:
+                self._idle.set()
+
+    def wrap(self, job):
+        """Оборачивает задачу планировщика, чтобы остановка её дождалась"""
+        @functools.wraps(job)
+        async def wrapper(*args, **kwargs):
+            async with self.track():
+                return await job(*args, **kwargs)
+
+        return wrapper
+
+    async def wait_idle(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+in_flight = InFlightTracker()
+
+
+async def drain(scheduler=None, timeout: float = SHUTDOWN_TIMEOUT):
+    """Первый этап остановки: новые запуски задач прекращаются, начатые
+    обработчики и задачи получают до timeout секунд на завершение.
+
+    APScheduler при shutdown() отменяет выполняющиеся корутины, поэтому
+    сначала ставим его на паузу и ждём, и только потом останавливаем.
+    """
+    in_flight.stopping = True
+    if scheduler is not None and scheduler.running:
+        scheduler.pause()
+
+    if in_flight.count:
+        logger.info("Ожидание завершения %s обработчиков и задач", in_flight.count)
+    if not await in_flight.wait_idle(timeout):
+        logger.warning("За %s сек. не завершились %s обработчиков и задач, они будут прерваны", timeout, in_flight.count)
+
+    if scheduler is not None and scheduler.running:
+        scheduler.shutdown(wait=False)
@@ -0,0 +1,66 @@
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from config import SLOT_HOLD_SECONDS
+
+
+class SlotHolds:
+    """Удержание выбранного времени до подтверждения записи.
+
+    Пользователь выбирает время и подтверждает запись отдельным шагом; всё
+    это время оно закреплено за ним и не показывается другим пользователям
+    в get_times_keyboard, и они не выбирают его только для того, чтобы
+    получить "уже занято". Удержание снимается после записи или переноса,
+    по кнопке "Назад" и при выборе другого времени, а если пользователь
+    ушёл из диалога - истекает само через ttl секунд.
+
+    Удержание относится к месту конкретного мастера (None - общий зал), как и
+    запись: удержание у одного мастера не скрывает свободное время другого.
+
+    Удержания хранятся в памяти процесса и лишь уменьшают число гонок;
+    от двойной записи защищают блокировки и ограничения в БД.
+    """
+
+    def __init__(self, ttl: float = SLOT_HOLD_SECONDS):
+        self.ttl = ttl
+        # telegram id -> (мастер, начало, конец, момент истечения); у пользователя одно удержание
+        self._holds: Dict[int, Tuple[Optional[int], datetime, datetime, float]] = {}
+
+    def hold(self, telegram_id: int, start: datetime, duration: int, staff_id: Optional[int] = None):
+        self._holds[telegram_id] = (
+            staff_id, start, start + timedelta(minutes=duration), time.monotonic() + self.ttl
+        )
+
+    def release(self, telegram_id: int):
+        self._holds.pop(telegram_id, None)
+
+    def held_staff(self, telegram_id: int) -> Optional[int]:
+        """Мастер, у которого пользователь удерживает время; None - нет удержания или общий зал"""
+        self._evict_expired()
+        held = self._holds.get(telegram_id)
+        return held[0] if held else None
+
+    def count_overlaps(
+        self,
+        staff_id: Optional[int],
+        start: datetime,
+        end: datetime,
+        exclude_telegram_id: Optional[int] = None
+    ) -> int:
+        """Сколько чужих действующих удержаний у мастера staff_id пересекают [start, end)"""
+        self._evict_expired()
+        return sum(
+            1 for key, (held_staff, held_start, held_end, _) in self._holds.items()
+            if key != exclude_telegram_id and held_staff == staff_id
+            and held_start < end and start < held_end
+        )
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [key for key, (*_, expires) in self._holds.items() if expires <= now]
+        for key in expired:
+            del self._holds[key]
+
+
+slot_holds = SlotHolds()
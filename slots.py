@@ -0,0 +1,133 @@
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Schedule, Booking
+from statements import SLOTS_IN_RANGE, OVERLAPPING_BOOKINGS, OVERLAPPING_BOOKINGS_EXCLUDING
+
+
+class IntervalIndex:
+    """Отсортированный массив интервалов занятости одного мастера (или общего зала).
+
+    Поиск пересечений - бинарный поиск по началам интервалов, поэтому проверка
+    слота не замедляется с ростом числа записей за день.
+    """
+
+    def __init__(self, intervals: Iterable[Tuple[datetime, datetime]] = ()):
+        self._intervals = sorted(intervals)
+        self._starts = [start for start, _ in self._intervals]
+        self._max_length = max(
+            (end - start for start, end in self._intervals),
+            default=timedelta(0)
+        )
+
+    def count_overlaps(self, start: datetime, end: datetime) -> int:
+        """Количество интервалов, пересекающихся с [start, end)"""
+        # Интервал, начавшийся раньше start - max_length, уже закончился
+        lo = bisect_left(self._starts, start - self._max_length)
+        hi = bisect_left(self._starts, end)
+        return sum(1 for _, busy_end in self._intervals[lo:hi] if busy_end > start)
+
+
+def overlapping_bookings_query(start: datetime, end: datetime, exclude_booking_id: int = None):
+    """Подтверждённые записи, пересекающиеся с интервалом [start, end)"""
+    query = select(Booking.staff_id, Booking.date, Booking.end_date).where(
+        Booking.confirmed == True,
+        Booking.date < end,
+        Booking.end_date > start
+    )
+    if exclude_booking_id:
+        query = query.where(Booking.id != exclude_booking_id)
+    return query
+
+
+async def fetch_overlapping_bookings(
+    session: AsyncSession,
+    start: datetime,
+    end: datetime,
+    exclude_booking_id: int = None
+):
+    """То же, что overlapping_bookings_query, через заранее собранные запросы"""
+    if exclude_booking_id:
+        return await session.execute(
+            OVERLAPPING_BOOKINGS_EXCLUDING,
+            {"start": start, "end": end, "exclude_booking_id": exclude_booking_id}
+        )
+    return await session.execute(OVERLAPPING_BOOKINGS, {"start": start, "end": end})
+
+
+def build_indexes(bookings) -> defaultdict:
+    """Индексы занятости по мастерам; ключ None - общие места без мастера"""
+    intervals = defaultdict(list)
+    for staff_id, start, end in bookings:
+        intervals[staff_id].append((start, end))
+    return defaultdict(IntervalIndex, {
+        staff_id: IntervalIndex(busy) for staff_id, busy in intervals.items()
+    })
+
+
+async def get_free_places(
+    session: AsyncSession,
+    start: datetime,
+    end: datetime,
+    duration: int,
+    exclude_booking_id: int = None
+) -> List[Tuple[object, int]]:
+    """Слоты с началом в [start, end), в которые услуга длительностью duration минут
+    помещается целиком, и число свободных мест в каждом (capacity минус записи).
+    Два запроса независимо от числа слотов и записей."""
+    length = timedelta(minutes=duration)
+
+    slots = await session.execute(SLOTS_IN_RANGE, {"start": start, "end": end})
+    bookings = await fetch_overlapping_bookings(session, start, end + length, exclude_booking_id)
+    indexes = build_indexes(bookings)
+
+    places = []
+    for slot in slots:
+        free = slot.capacity - indexes[slot.staff_id].count_overlaps(slot.date, slot.date + length)
+        if free > 0:
+            places.append((slot, free))
+    return places
+
+
+async def find_free_slot(
+    session: AsyncSession,
+    when: datetime,
+    duration: int,
+    exclude_booking_id: int = None,
+    preferred_staff_id: int = None
+) -> Tuple[bool, Optional[object]]:
+    """Блокирует слоты на время услуги и возвращает первый, куда она помещается.
+
+    Слот мастера preferred_staff_id (за ним пользователь удерживал время)
+    проверяется первым. Возвращает пару (есть ли слоты на это время, строка
+    слота (id, staff_id) или None). Количество запросов не зависит от числа
+    мастеров на это время.
+    """
+    end = when + timedelta(minutes=duration)
+
+    # Блокируем все слоты внутри интервала услуги: любые две пересекающиеся
+    # записи блокируют слот, с которого начинается более поздняя из них
+    slots = await session.execute(
+        select(Schedule.id, Schedule.date, Schedule.staff_id, Schedule.capacity)
+        .where(Schedule.date >= when, Schedule.date < end)
+        .order_by(Schedule.id)
+        .with_for_update()
+    )
+    slots = [slot for slot in slots if slot.date == when]
+    if preferred_staff_id is not None:
+        slots.sort(key=lambda slot: slot.staff_id != preferred_staff_id)
+    if not slots:
+        return False, None
+
+    bookings = await fetch_overlapping_bookings(session, when, end, exclude_booking_id)
+    indexes = build_indexes(bookings)
+
+    for slot in slots:
+        if indexes[slot.staff_id].count_overlaps(when, end) < slot.capacity:
+            return True, slot
+    return True, None
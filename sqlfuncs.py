@@ -0,0 +1,61 @@
+"""Функции дат, одинаково работающие в PostgreSQL и SQLite.
+
+Группировка по дню и месяцу делается в БД, а форматирование для кнопок -
+в Python: to_char и date_trunc есть только в PostgreSQL.
+"""
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.types import Date, DateTime
+
+
+class day_start(FunctionElement):
+    """Дата (без времени) от значения DateTime"""
+    type = Date()
+    name = "day_start"
+    inherit_cache = True
+
+
+class month_start(FunctionElement):
+    """Первое число месяца от значения DateTime"""
+    type = Date()
+    name = "month_start"
+    inherit_cache = True
+
+
+@compiles(day_start)
+def _day_start_default(element, compiler, **kw):
+    return "CAST(%s AS DATE)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(day_start, "sqlite")
+def _day_start_sqlite(element, compiler, **kw):
+    return "date(%s)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(month_start)
+def _month_start_default(element, compiler, **kw):
+    return "CAST(date_trunc('month', %s) AS DATE)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(month_start, "sqlite")
+def _month_start_sqlite(element, compiler, **kw):
+    return "date(%s, 'start of month')" % compiler.process(element.clauses, **kw)
+
+
+class db_now(FunctionElement):
+    """Текущее время по часам сервера БД (без часового пояса), сдвинутое на
+    указанное число секунд: db_now(-300) - пять минут назад. Сроки аренд и
+    заданий, которые сравнивают разные процессы, считаются по одним часам"""
+    type = DateTime()
+    name = "db_now"
+    inherit_cache = True
+
+
+@compiles(db_now)
+def _db_now_default(element, compiler, **kw):
+    return "(LOCALTIMESTAMP + %s * INTERVAL '1 second')" % compiler.process(element.clauses, **kw)
+
+
+@compiles(db_now, "sqlite")
+def _db_now_sqlite(element, compiler, **kw):
+    return "datetime('now', 'localtime', %s || ' seconds')" % compiler.process(element.clauses, **kw)
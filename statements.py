@@ -0,0 +1,71 @@
+"""Заранее собранные запросы для горячих путей.
+
+Запрос строится один раз при импорте, значения передаются параметрами:
+session.execute(USER_BY_TELEGRAM_ID, {"telegram_id": "123"}). Ключ кэша
+компиляции SQLAlchemy у такого объекта вычисляется один раз, а одинаковый
+текст SQL позволяет asyncpg повторно использовать подготовленный оператор
+на соединении (см. prepared_statement_cache_size в database.py).
+"""
+from sqlalchemy import bindparam, select
+
+from models import Booking, Schedule, Service, User
+
+# Пользователь по telegram_id (строкой)
+USER_BY_TELEGRAM_ID = select(User).where(User.telegram_id == bindparam("telegram_id"))
+
+# Только id пользователя - для списков, где сам объект не нужен
+USER_ID_BY_TELEGRAM_ID = select(User.id).where(User.telegram_id == bindparam("telegram_id"))
+
+# Услуга по названию
+SERVICE_BY_NAME = select(Service).where(Service.name == bindparam("name"))
+
+# Списки для показа выбирают только нужные колонки: строки-кортежи
+# без ORM-объектов и учёта в identity map сессии
+
+# Предстоящие записи пользователя (user_id, now)
+UPCOMING_USER_BOOKINGS = (
+    select(Booking.id, Booking.date, Booking.confirmed, Service.name.label("service_name"))
+    .join(Service)
+    .where(Booking.user_id == bindparam("user_id"), Booking.date >= bindparam("now"))
+    .order_by(Booking.date)
+)
+
+# Предстоящие подтверждённые записи пользователя - те, что можно отменить
+UPCOMING_CONFIRMED_USER_BOOKINGS = UPCOMING_USER_BOOKINGS.where(Booking.confirmed == True)
+
+# Все записи за интервал [start, end) с клиентами - для администратора
+BOOKINGS_IN_RANGE = (
+    select(
+        Booking.id,
+        Booking.date,
+        Booking.confirmed,
+        User.first_name,
+        User.last_name,
+        User.phone,
+        Service.name.label("service_name"),
+        Service.price
+    )
+    .join(User, Booking.user_id == User.id)
+    .join(Service, Booking.service_id == Service.id)
+    .where(Booking.date >= bindparam("start"), Booking.date < bindparam("end"))
+    .order_by(Booking.date)
+)
+
+# Слоты с началом в [start, end)
+SLOTS_IN_RANGE = (
+    select(Schedule.id, Schedule.date, Schedule.staff_id, Schedule.capacity)
+    .where(Schedule.date >= bindparam("start"), Schedule.date < bindparam("end"))
+    .order_by(Schedule.date, Schedule.id)
+)
+
+# Подтверждённые записи, пересекающиеся с [start, end)
+OVERLAPPING_BOOKINGS = select(Booking.staff_id, Booking.date, Booking.end_date).where(
+    Booking.confirmed == True,
+    Booking.date < bindparam("end"),
+    Booking.end_date > bindparam("start")
+)
+
+# То же без переносимой записи (exclude_booking_id)
+OVERLAPPING_BOOKINGS_EXCLUDING = OVERLAPPING_BOOKINGS.where(
+    Booking.id != bindparam("exclude_booking_id")
+)
@@ -10,12 +10,14 @@ class BookingStates(StatesGroup):
     waiting_for_month = State()
     waiting_for_day = State()
     waiting_for_time = State()
+    waiting_for_confirmation = State()
 
 class RescheduleStates(StatesGroup):
     waiting_for_booking = State()
     waiting_for_new_month = State()
     waiting_for_new_day = State()
     waiting_for_new_time = State()
+    waiting_for_confirmation = State()
 
 class CancelStates(StatesGroup):
     waiting_for_booking = State()
@@ -0,0 +1,85 @@
+"""Фоновый воркер: напоминания, архивация и рассылки.
+
+Запуск: python -m worker. Обработчики апдейтов при этом работают в bot.py
+(с RUN_WORKER_IN_BOT=0), и медленная рассылка не задерживает ответы пользователям.
+"""
+import asyncio
+import logging
+import signal
+from datetime import datetime
+
+from aiogram import Bot
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from archive import archive_past_records
+from audit import audit_log
+from broadcasts import process_broadcast_queue
+from config import TOKEN, BROADCAST_POLL_INTERVAL
+from database import dispose_engines
+from health import health
+from keyboards import CachedMarkupSession
+from leader import leader
+from log_setup import setup_logging
+from reminders import send_booking_reminders
+from shutdown import drain, in_flight
+
+logger = logging.getLogger(__name__)
+
+
+def setup_jobs(scheduler: AsyncIOScheduler, bot: Bot):
+    """Регистрирует фоновые задачи в планировщике. Напоминания и архивация
+    выполняются только на ведущей реплике; очередь рассылок безопасно
+    разбирать с нескольких реплик (SKIP LOCKED)"""
+    # Передаем экземпляр бота в функцию напоминаний. Запрос "что пора отправить"
+    # идёт по частичному индексу, поэтому его можно выполнять часто
+    scheduler.add_job(
+        in_flight.wrap(leader.leader_only(send_booking_reminders)),
+        'interval',
+        minutes=5,
+        args=[bot],  # Передаем бота как аргумент
+        next_run_time=datetime.now(),
+        max_instances=1
+    )
+    # Ночной перенос прошедших записей и слотов в архив
+    scheduler.add_job(in_flight.wrap(leader.leader_only(archive_past_records)), 'cron', hour=3, minute=0)
+    # Очередь рассылок, которые ставит администратор
+    scheduler.add_job(
+        in_flight.wrap(process_broadcast_queue),
+        'interval',
+        seconds=BROADCAST_POLL_INTERVAL,
+        args=[bot],
+        max_instances=1
+    )
+
+
+async def main():
+    bot = Bot(token=TOKEN, session=CachedMarkupSession())
+    scheduler = AsyncIOScheduler()
+    setup_jobs(scheduler, bot)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    audit_log.start()
+    await leader.start()
+    scheduler.start()
+    health.scheduler = scheduler
+    await health.start()
+    logger.info("Воркер запущен")
+    try:
+        await stop.wait()
+    finally:
+        await drain(scheduler)
+        await leader.stop()
+        await audit_log.stop()
+        await bot.session.close()
+        await health.stop()
+        await dispose_engines()
+        logger.info("Воркер остановлен")
+
+
+if __name__ == "__main__":
+    setup_logging()
+    asyncio.run(main())